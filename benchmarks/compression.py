@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding: utf-8
+''' Benchmark of compressed-at-rest storage on a sample of downloaded documents
+    usage: compression.py [-h] [--sample SAMPLE] [--seed SEED] [--debug] folder
+
+Applies the COMPRESSION_POLICY of ntp_constants to documents in a disk
+storage folder and reports, per document type, stored volume, GridFS
+chunks and read (decompression) latency.
+
+positional arguments:
+  folder           Disk storage folder with downloaded documents
+
+options:
+  -h, --help       show this help message and exit
+  --sample SAMPLE  Number of documents to sample (default: 1000)
+  --seed SEED      Random seed for sampling (default: 0)
+  --debug          Extra debug information
+'''
+import sys
+import os
+import argparse
+import logging
+import math
+import random
+import time
+from collections import defaultdict
+from nextplib import ntp_storage as ntpst
+
+# Default GridFS chunk size
+GRIDFS_CHUNK = 255 * 1024
+
+def print_row(label, row):
+    ''' Print summary line for a document type'''
+    print(
+        f"{label:6} {row['files']:6.0f} {row['compressed']:6.0f} "
+        f"{row['raw_bytes'] / 1024 / 1024:9.1f} {row['stored_bytes'] / 1024 / 1024:9.1f} "
+        f"{row['stored_bytes'] / max(row['raw_bytes'], 1):6.2f} "
+        f"{row['raw_chunks']:10.0f} {row['stored_chunks']:13.0f} "
+        f"{row['read_ms'] / row['files']:8.2f} {row['decode_ms'] / row['files']:9.2f}"
+    )
+
+def main():
+    ''' Main '''
+    parser = argparse.ArgumentParser(description='Compression benchmark')
+    parser.add_argument('--sample', action='store', type=int, default=1000, help='Number of documents to sample (default: 1000)')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='Random seed for sampling (default: 0)')
+    parser.add_argument('--debug', action='store_true', help='Extra debug information')
+    parser.add_argument('folder', help='Disk storage folder with downloaded documents')
+
+    args = parser.parse_args()
+    # Setup logging
+    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
+    if args.debug:
+        logging.getLogger().setLevel(10)
+    else:
+        logging.getLogger().setLevel(20)
+
+    if ntpst.zstandard is None:
+        logging.error("zstandard module not available")
+        sys.exit(1)
+
+    storage = ntpst.NtpStorageDisk(data_dir=args.folder)
+    files = sorted(storage.file_list())
+    random.seed(args.seed)
+    sample = random.sample(files, min(args.sample, len(files)))
+    logging.info(f"{len(sample)} documents sampled from {len(files)} at {args.folder}")
+
+    stats = defaultdict(lambda: defaultdict(float))
+    for file_name in sample:
+        doc_type = os.path.splitext(file_name)[1].replace('.', '').lower()
+        start = time.perf_counter()
+        contents = storage.file_read(file_name)
+        raw_read = time.perf_counter() - start
+        stored, metadata = ntpst.compress_contents(file_name, contents)
+        start = time.perf_counter()
+        ntpst.decompress_contents(stored, metadata.get('codec'))
+        decode = time.perf_counter() - start
+        type_stats = stats[doc_type]
+        type_stats['files'] += 1
+        type_stats['compressed'] += 1 if metadata else 0
+        type_stats['raw_bytes'] += len(contents)
+        type_stats['stored_bytes'] += len(stored)
+        type_stats['raw_chunks'] += math.ceil(len(contents) / GRIDFS_CHUNK)
+        type_stats['stored_chunks'] += math.ceil(len(stored) / GRIDFS_CHUNK)
+        type_stats['read_ms'] += raw_read * 1000
+        type_stats['decode_ms'] += decode * 1000
+
+    print(
+        f"{'type':6} {'files':>6} {'compr.':>6} {'raw MB':>9} {'stored MB':>9} {'ratio':>6} "
+        f"{'raw chunks':>10} {'stored chunks':>13} {'read ms':>8} {'decode ms':>9}"
+    )
+    totals = defaultdict(float)
+    for doc_type in sorted(stats):
+        type_stats = stats[doc_type]
+        for key, value in type_stats.items():
+            totals[key] += value
+        print_row(doc_type, type_stats)
+    if totals['files']:
+        print_row('total', totals)
+
+if __name__ == "__main__":
+    main()
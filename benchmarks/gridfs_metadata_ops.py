@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+''' Benchmark of MongoDB operations per stored/read file on GridFS storage
+    usage: gridfs_metadata_ops.py [-h] [--config CONFIG] [--bucket BUCKET]
+                                  [--num_files NUM_FILES] [--size SIZE] [--debug]
+
+Compares the legacy GridFS access pattern (exists + find_one + get/delete + put)
+against NtpStorageGridFs (GridFSBucket based). Uses a scratch bucket that is
+dropped at the end.
+
+options:
+  -h, --help             show this help message and exit
+  --config CONFIG        Configuration file (default: secrets.yml)
+  --bucket BUCKET        Scratch bucket name (default: benchmark_fs)
+  --num_files NUM_FILES  Number of files per test (default: 100)
+  --size SIZE            File size in bytes (default: 300000)
+  --debug                Extra debug information
+'''
+import sys
+import os
+import argparse
+import logging
+import time
+from collections import Counter
+from yaml import load, CLoader
+from pymongo import monitoring
+from gridfs import GridFS
+from nextplib import ntp_storage as ntpst
+from mmb_data.mongo_db_connect import Mongo_db
+
+
+class CommandCounter(monitoring.CommandListener):
+    ''' Counts commands sent to files and chunks collections'''
+    def __init__(self, bucket):
+        self.files_col = f"{bucket}.files"
+        self.chunks_col = f"{bucket}.chunks"
+        self.counts = Counter()
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if target == self.files_col or event.command_name in ('listIndexes', 'createIndexes'):
+            self.counts['metadata'] += 1
+        elif target == self.chunks_col:
+            self.counts['chunks'] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        self.counts = Counter()
+
+
+class LegacyGridFs:
+    ''' Access pattern of the former NtpStorageGridFs (GridFS based)'''
+    def __init__(self, gridfs_obj):
+        self.gridfs = gridfs_obj
+
+    def file_store(self, file_name, contents):
+        self.delete_file(file_name)
+        self.gridfs.put(contents, filename=file_name)
+
+    def file_read(self, file_name):
+        if self.gridfs.exists(filename=file_name):
+            file_id = self.gridfs.find_one({'filename':file_name})._id
+            return self.gridfs.get(file_id).read()
+        return ''
+
+    def delete_file(self, file_name):
+        if self.gridfs.exists(filename=file_name):
+            file_id = self.gridfs.find_one({'filename':file_name})._id
+            self.gridfs.delete(file_id)
+
+
+def run_test(label, storage, counter, num_files, contents):
+    ''' Store (twice, to include replacement) and read num_files files'''
+    results = []
+    names = [f"ntp{str(i).zfill(8)}_benchmark.pdf" for i in range(num_files)]
+    for step in ('store', 'replace', 'read'):
+        counter.reset()
+        start = time.time()
+        for name in names:
+            if step == 'read':
+                storage.file_read(name)
+            else:
+                storage.file_store(name, contents)
+        elapsed = time.time() - start
+        results.append((
+            label, step,
+            counter.counts['metadata'] / num_files,
+            counter.counts['chunks'] / num_files,
+            elapsed * 1000 / num_files
+        ))
+    return results
+
+
+def main():
+    ''' Main '''
+    parser = argparse.ArgumentParser(description='GridFS metadata operations benchmark')
+    parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default: secrets.yml)')
+    parser.add_argument('--bucket', action='store', default='benchmark_fs', help='Scratch bucket name (default: benchmark_fs)')
+    parser.add_argument('--num_files', action='store', type=int, default=100, help='Number of files per test (default: 100)')
+    parser.add_argument('--size', action='store', type=int, default=300000, help='File size in bytes (default: 300000)')
+    parser.add_argument('--debug', action='store_true', help='Extra debug information')
+
+    args = parser.parse_args()
+    # Setup logging
+    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
+    if args.debug:
+        logging.getLogger().setLevel(10)
+    else:
+        logging.getLogger().setLevel(20)
+
+    # Config file
+    with open(args.config, 'r')  as config_file:
+        config = load(config_file, Loader=CLoader)
+
+    # Listener must be registered before the client is created
+    counter = CommandCounter(args.bucket)
+    monitoring.register(counter)
+
+    logging.info(f"Connecting to MongoDB at {config['MONGODB_HOST']}")
+    db_lnk = Mongo_db(
+        config['MONGODB_HOST'],
+        config['MONGODB_DB'],
+        False,
+        config['MONGODB_AUTH'],
+        credentials=config['MONGODB_CREDENTIALS'],
+        connect_db=True
+    )
+
+    contents = os.urandom(args.size)
+    results = []
+    for label, storage in (
+        ('legacy', LegacyGridFs(GridFS(db_lnk.db, args.bucket))),
+        ('bucket', ntpst.NtpStorageGridFs(db=db_lnk.db, bucket_name=args.bucket))
+    ):
+        logging.info(f"Running {label} test, {args.num_files} files of {args.size} bytes")
+        results += run_test(label, storage, counter, args.num_files, contents)
+        db_lnk.db.drop_collection(f"{args.bucket}.files")
+        db_lnk.db.drop_collection(f"{args.bucket}.chunks")
+
+    print(f"{'storage':8} {'step':8} {'meta ops/file':>14} {'chunk ops/file':>15} {'ms/file':>10}")
+    for label, step, meta_ops, chunk_ops, msecs in results:
+        print(f"{label:8} {step:8} {meta_ops:14.2f} {chunk_ops:15.2f} {msecs:10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+''' Script to build the version chains index of a place collection
+    usage: build_versions_index.py [-h] [--config CONFIG] [-v] [--debug] [--drop] --group GROUP
+
+Build version chains index
+
+options:
+  -h, --help       show this help message and exit
+  --config CONFIG  Configuration file (default: secrets.yml)
+  -v, --verbose    Extra progress information
+  --debug          Extra debug information
+  --drop           Drop existing index collection before building
+  --group GROUP    outsiders|minors
+'''
+import sys
+import argparse
+import logging
+from yaml import load, CLoader
+from nextplib import ntp_versions
+from mmb_data.mongo_db_connect import Mongo_db
+
+def main():
+    ''' Main '''
+    parser = argparse.ArgumentParser(description='Build version chains index')
+    parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default:secrets.yml)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
+    parser.add_argument('--debug',action='store_true', help='Extra debug information')
+    parser.add_argument('--drop', action='store_true', help='Drop existing index collection before building')
+    parser.add_argument('--group', action='store', help='outsiders|minors', required=True)
+
+    args = parser.parse_args()
+    # Setup logging
+    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
+    if args.debug:
+        logging.getLogger().setLevel(10)
+    else:
+        logging.getLogger().setLevel(20)
+
+    # Config file
+    with open(args.config, 'r')  as config_file:
+        config = load(config_file, Loader=CLoader)
+
+    logging.info(f"Connecting to MongoDB at {config['MONGODB_HOST']}")
+
+    db_lnk = Mongo_db(
+        config['MONGODB_HOST'],
+        config['MONGODB_DB'],
+        False,
+        config['MONGODB_AUTH'],
+        credentials=config['MONGODB_CREDENTIALS'],
+        connect_db=True
+    )
+    incoming_col = db_lnk.db.get_collection(config[f'{args.group}_col_prefix'])
+    version_index = ntp_versions.VersionIndex(db_lnk.db, incoming_col.name)
+    logging.info(f"Building {version_index.col.name} from {incoming_col.name}")
+
+    if args.drop:
+        logging.info(f"Dropping {version_index.col.name}")
+        version_index.col.drop()
+
+    num_chains = version_index.rebuild(incoming_col)
+    logging.info(f"{num_chains} version chains stored")
+
+if __name__ == "__main__":
+    main()
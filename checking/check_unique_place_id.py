@@ -1,31 +1,31 @@
 #!/usr/bin/env python
 # coding: utf-8
-''' Script to build historical on place
-    usage: process_place.py [-h] [--ini INI] [--fin FIN] [--id ID]
+''' Script to find place ids (last component of id) shared by different ids
+    usage: check_unique_place_id.py [-h] [--config CONFIG] [-v] [--debug] [--output OUTPUT]
+
+Conflicts are found server-side on place and place_menores, and written
+as JSON lines {"place_id": ..., "ids": [...], "collections": [...]}
 '''
 import sys
 import argparse
 import logging
-import os
-import time
+import json
 from yaml import load, CLoader
-import ntp_entry as ntp
-import ntp_storage as ntpst
 from mmb_data.mongo_db_connect import Mongo_db
 
 
 def main():
     ''' Main '''
 
-    parser = argparse.ArgumentParser(description='Download documents')
+    parser = argparse.ArgumentParser(description='Check unique place ids')
     parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default;secrets.yml)')
-    parser.add_argument('--type', action='store', default='mayores', help='Mayores (no menores) | menores')
+    parser.add_argument('--output', action='store', help='Output file (default: stdout)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
     parser.add_argument('--debug',action='store_true', help='Extra debug information')
 
     args = parser.parse_args()
     # Setup logging
-    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
+    logging.basicConfig(stream=sys.stderr, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
     if args.debug:
         logging.getLogger().setLevel(10)
     else:
@@ -45,20 +45,47 @@ def main():
         credentials=config['MONGODB_CREDENTIALS'],
         connect_db=True
     )
-    IDS = {}
-    for coll in ['place', 'place_menores']:
-        incoming_col = db_lnk.db.get_collection(coll)
-        for doc in incoming_col.find({}, projection={'id':1, '_id':0}):
-            place_id = os.path.basename(doc['id'])
-            if args.verbose:
-                logging.info(f"Processing {place_id} from {doc['id']}")
-            if place_id not in IDS:
-                IDS[place_id] = set()
-            IDS[place_id].add(doc['id'])
-            if len(IDS[place_id]) > 1:
-                logging.warning(IDS[place_id])
-    for place_id in sorted(IDS):
-        print(place_id, IDS[place_id])
+    place_cols = [config[f"{group}_col_prefix"] for group in ('outsiders', 'minors')]
+    incoming_col = db_lnk.db.get_collection(place_cols[0])
+
+    if args.output:
+        output_file = open(args.output, 'w')
+    else:
+        output_file = sys.stdout
+
+    num_conflicts = 0
+    for doc in incoming_col.aggregate(get_conflicts_pipeline(place_cols), allowDiskUse=True):
+        if args.verbose:
+            logging.warning(f"{doc['_id']}: {doc['ids']}")
+        print(json.dumps({'place_id': doc['_id'], 'ids': sorted(doc['ids']), 'collections': sorted(doc['collections'])}), file=output_file)
+        num_conflicts += 1
+
+    if args.output:
+        output_file.close()
+    logging.info(f"{num_conflicts} place ids found with more than one id")
+
+
+def get_conflicts_pipeline(place_cols):
+    ''' Aggregation grouping ids of all place_cols by place id (last component
+        of id), returning only place ids with more than one id'''
+    pipeline = [{'$project': {'_id': 0, 'id': 1, 'col': {'$literal': place_cols[0]}}}]
+    for col_name in place_cols[1:]:
+        pipeline.append({'$unionWith': {
+            'coll': col_name,
+            'pipeline': [{'$project': {'_id': 0, 'id': 1, 'col': {'$literal': col_name}}}]
+        }})
+    pipeline += [
+        {'$match': {'id': {'$type': 'string'}}},
+        {'$group': {
+            '_id': {'$arrayElemAt': [{'$split': ['$id', '/']}, -1]},
+            'ids': {'$addToSet': '$id'},
+            'collections': {'$addToSet': '$col'}
+        }},
+        {'$match': {'$expr': {'$gt': [{'$size': '$ids'}, 1]}}},
+        {'$sort': {'_id': 1}}
+    ]
+    return pipeline
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
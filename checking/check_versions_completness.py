@@ -1,16 +1,27 @@
 #!/usr/bin/env python
 # coding: utf-8
-''' Script to build historical on place
-    usage: process_place.py [-h] [--ini INI] [--fin FIN] [--id ID]
+''' Script to check version chains on place collections
+    usage: check_versions_completness.py [-h] [--config CONFIG] [--group GROUP] [-v] [--debug] [--dry_run] [--batch_size BATCH_SIZE]
+
+Check versioned documents. The collection is read once in _id order, and
+version pointers are checked in memory for:
+  gaps             ntp ids missing in the collection, recovered from place_old as obsolete versions
+  missing          obsolete versions without updated_to
+  dangling         updated_to pointing to a non existent document
+  multi_hop        updated_to pointing to another obsolete version
+  multiple active  place ids with more than one active version (reported only)
+Pointers are fixed to the active version of the place id, fixes are committed as bulk writes.
+Recovered versions are added to the version chains index (<collection>_versions).
 '''
 import sys
 import argparse
 import logging
-import os
-import time
+import itertools
+import numpy as np
 from yaml import load, CLoader
-from nextplib import ntp_entry as ntp, ntp_constants as cts, ntp_utils as nu
+from nextplib import ntp_utils as nu, ntp_graph as ntpg, ntp_versions
 from mmb_data.mongo_db_connect import Mongo_db
+from mmb_data.mongo_db_bulk_write import MongoDBBulkWrite, CTS
 
 
 def main():
@@ -21,6 +32,8 @@ def main():
     parser.add_argument('--group', action='store', help='Group (outsiders|insiders|minors)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
     parser.add_argument('--debug',action='store_true', help='Extra debug information')
+    parser.add_argument('--dry_run', action='store_true', help='Do not fix documents, just report')
+    parser.add_argument('--batch_size', action='store', type=int, default=1000, help='Bulk write and place_old lookup batch size')
 
     args = parser.parse_args()
     # Setup logging
@@ -48,75 +61,131 @@ def main():
     if args.group in ['insiders', 'outsiders']:
         incoming_col = db_lnk.db.get_collection('place')
         place_old_col = db_lnk.db.get_collection('place_old')
-        cond = {'_id': {'$regex': 'ntp0'}}
+        cond = {'_id': {'$gte': 'ntp00000001', '$lt': 'ntp10000000'}}
         ini_doc = 1
     elif args.group in ['minors']:
         incoming_col = db_lnk.db.get_collection('place_menores')
         place_old_col = db_lnk.db.get_collection('place_menores_old')
-        cond = {'_id': {'$regex': 'ntp1'}}
+        cond = {'_id': {'$gte': 'ntp10000000', '$lt': 'ntp20000000'}}
         ini_doc = 10000000
-
-    max_id_c = incoming_col.aggregate(
-        [
-            {'$match': cond},
-            {'$group':{'_id':'max_id', 'value':{'$max': '$_id'}}}
-        ]
-    )
-    max_id = list(max_id_c)
-    if max_id:
-        id_num = nu.parse_ntp_id(max_id[0]['value'])
     else:
+        logging.error(f"Group {args.group} invalid or missing")
+        sys.exit()
+
+    logging.info(f"Loading versions from {incoming_col.name}")
+    graph = ntpg.VersionGraph.from_collection(incoming_col, cond)
+    if not len(graph):
         logging.info(f"No records found of the required type on {incoming_col.name}")
+        return
+    logging.info(
+        f"{len(graph)} documents, {len(graph.place_ids)} place ids loaded "
+        f"({graph.memory_usage() / 1024 / 1024:.1f} MB)"
+    )
 
-    for ntp_order in range(ini_doc, id_num):
-        doc = ntp.NtpEntry()
-        doc.ntp_order = ntp_order
-        doc.set_ntp_id()
-        logging.info(f"Processing {doc.ntp_id}")
-        if doc.load_from_db(incoming_col, doc.ntp_id):
-            if doc.is_obsolete():
-                logging.info("Document found marked as obsolete version")
-                if not doc.data['updated_to']:
-                    # No reference to final doc, fetching from id
-                    last_vers = nu.get_active_version(doc.data['id'], incoming_col)
-                    if last_vers:
-                        logging.info(f"Active document for place_id {doc.data['id']} found at {last_vers}, updating")
-                        doc.data['updated_to'] = last_vers
-                        doc.commit_to_db(incoming_col)
-                final_doc = ntp.NtpEntry()
-                if not final_doc.load_from_db(incoming_col, doc.data['updated_to']):
-                    logging.error(f"Final document for ntp_id {doc.ntp_id} ({doc.data['updated_to']}) not found")
-                    while final_doc.is_obsolete():
-                        logging.warning(f"updated_to points to another obsolete_version")
-                        final_doc.load_from_db(incoming_col, final_doc.data['updated_to'])
-                    doc.data['updated_to'] = final_doc.ntp_id
-                    logging.info(f"Updating pointer to {final_doc.ntp_id}")
-                    doc.commit_to_db(incoming_col)
-                else:
-                    logging.info(f"Document found updated on {final_doc.ntp_id}")
-            else:
-                logging.info("Document found as active version")
-        else:
-            logging.warning(f"Document {doc.ntp_id} not found, recovering from old collection")
-            recovered_doc = ntp.NtpEntry()
-            if recovered_doc.load_from_db(place_old_col, doc.ntp_id):
-                final_doc= incoming_col.find_one({
-                    '$and': [
-                        {'id': recovered_doc.data['id']},
-                        {'obsolete_version': {'$exists':0}}
-                    ]
-                })
-                if final_doc:
-                    doc.data['id'] = recovered_doc.data['id']
-                    doc.make_obsolete(final_doc['_id'])
-                    doc.commit_to_db(incoming_col)
-                    logging.info(f"Document found updated on {final_doc['_id']}")
-                else:
-                    logging.error(f"Place id {recovered_doc.data['id']} not found")
+    report = check_versions(graph, ini_doc)
+
+    for place_id in report['multiple_active']:
+        logging.warning(f"Place id {place_id} has {report['multiple_active'][place_id]} active versions")
+    for ntp_id in report['orphans']:
+        logging.error(f"No active version found for obsolete {ntp_id}")
+    if args.verbose:
+        for ntp_id, final_id, problem in report['fixes']:
+            logging.info(f"{ntp_id} ({problem}) updating pointer to {final_id}")
+
+    bulk = MongoDBBulkWrite(incoming_col, CTS['UPSERT'], args.batch_size)
+    version_index = ntp_versions.VersionIndex(db_lnk.db, incoming_col.name, args.batch_size)
+    recovered_ids = {}
+    if not args.dry_run:
+        for ntp_id, final_id, problem in report['fixes']:
+            bulk.append({'_id': ntp_id}, {'$set': {'updated_to': final_id}})
+            bulk.commit_data_if_full()
+
+    num_recovered = 0
+    num_lost = 0
+    gaps = iter(report['gaps'])
+    while True:
+        gap_ids = [nu.get_ntp_id(ntp_order) for ntp_order in itertools.islice(gaps, args.batch_size)]
+        if not gap_ids:
+            break
+        recovered = {
+            doc['_id']: doc['id']
+            for doc in place_old_col.find({'_id': {'$in': gap_ids}}, projection={'_id': 1, 'id': 1})
+        }
+        for ntp_id in gap_ids:
+            if ntp_id not in recovered:
+                logging.debug(f"{ntp_id} not found on place legacy collection, skipping")
+                num_lost += 1
+                continue
+            final_id = get_active_id(graph, report, recovered[ntp_id])
+            if final_id is None:
+                logging.error(f"Place id {recovered[ntp_id]} not found")
+                num_lost += 1
+                continue
+            if args.verbose:
+                logging.info(f"{ntp_id} recovered, updated on {final_id}")
+            num_recovered += 1
+            if not args.dry_run:
+                # Same contents as NtpEntry.make_obsolete
+                bulk.append(
+                    {'_id': ntp_id},
+                    {'$set': {'id': recovered[ntp_id], 'obsolete_version': True, 'updated_to': final_id}}
+                )
+                bulk.commit_data_if_full()
+                recovered_ids.setdefault(recovered[ntp_id], []).append(ntp_id)
+    bulk.commit_any_data()
+    for place_id, ntp_ids in recovered_ids.items():
+        version_index.add_obsolete(place_id, ntp_ids)
+    version_index.flush()
+
+    logging.info(
+        f"{len(report['gaps'])} missing ids ({num_recovered} recovered, {num_lost} not found), "
+        f"{report['num_missing']} missing pointers, {report['num_dangling']} dangling pointers, "
+        f"{report['num_multi_hop']} multi hop pointers, {len(report['orphans'])} without active version, "
+        f"{len(report['multiple_active'])} place ids with multiple active versions"
+    )
+    if args.dry_run:
+        logging.info(f"{len(report['fixes']) + num_recovered} documents to fix (--dry_run)")
+
+
+def check_versions(graph, ini_doc):
+    ''' Check version pointers. Returns gaps (missing orders from ini_doc),
+        fixes as (ntp_id, active ntp_id, problem), obsolete versions without
+        active version (orphans), and place ids with multiple active versions'''
+    active, num_active = graph.active_versions()
+    report = {
+        'gaps': graph.gaps(ini_doc),
+        'fixes': [],
+        'orphans': [],
+        'multiple_active': {
+            graph.place_ids[code]: int(num_active[code])
+            for code in np.flatnonzero(num_active > 1)
+        },
+        'active': active
+    }
+    targets = graph.find(graph.pointers)
+    problems = {
+        'missing': graph.obsolete & (graph.pointers == ntpg.NO_CODE),
+        'dangling': graph.obsolete & (graph.pointers != ntpg.NO_CODE) & (targets == ntpg.NO_CODE),
+        'multi_hop': graph.obsolete & (targets != ntpg.NO_CODE) & graph.obsolete[targets]
+    }
+    for problem, found in problems.items():
+        report[f"num_{problem}"] = int(found.sum())
+        for pos in np.flatnonzero(found):
+            ntp_id = nu.get_ntp_id(graph.orders[pos])
+            code = graph.places[pos]
+            if code == ntpg.NO_CODE or active[code] == ntpg.NO_CODE:
+                report['orphans'].append(ntp_id)
             else:
-                logging.warning(f"{doc.ntp_id} not found on place legacy collection, skipping")
+                report['fixes'].append((ntp_id, nu.get_ntp_id(active[code]), problem))
+    return report
 
 
+def get_active_id(graph, report, place_id):
+    ''' Active ntp id for place_id, None if not found'''
+    code = graph.get_place_code(place_id)
+    if code == ntpg.NO_CODE or report['active'][code] == ntpg.NO_CODE:
+        return None
+    return nu.get_ntp_id(report['active'][code])
 
 
 if __name__ == "__main__":
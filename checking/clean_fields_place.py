@@ -1,39 +1,33 @@
 #!/usr/bin/env python
 # coding: utf-8
-''' Script to build historical on place
-    usage: process_place.py [-h] [--ini INI] [--fin FIN] [--id ID]
+''' Script to rename fields on place collections (place, place_menores)
+    usage: clean_fields_place.py [-h] [--ini INI] [--fin FIN] [--id ID] [--config CONFIG] [-v] [--debug] [--dry_run] [--batch_size BATCH_SIZE] fields
+
+Fields file holds old and new field names, tab separated. Values found at
+new fields are kept. All renames are applied server-side as pipeline
+updates (update_many), --dry_run reports the documents affected by each
+rename from a single aggregation.
 '''
 import sys
 import argparse
 import logging
-import os
-import time
 from yaml import load, CLoader
-import ntp_entry as ntp
-import ntp_storage as ntpst
+from nextplib import ntp_utils as nu
 from mmb_data.mongo_db_connect import Mongo_db
 
 
-def print_stats(lits):
-    stats = {}
-    for l in lits:
-        if len(lits[l]) not in stats:
-            stats[len(lits[l])] = 1
-        else:
-            stats[len(lits[l])] += 1
-    return stats
-
-
 def main():
     ''' Main '''
 
-    parser = argparse.ArgumentParser(description='Download documents')
+    parser = argparse.ArgumentParser(description='Rename fields')
     parser.add_argument('--ini', action='store', help='Initial document range')
     parser.add_argument('--fin', action='store', help='Final document range')
     parser.add_argument('--id', action='store', help='Selected document id')
     parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default;secrets.yml)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
     parser.add_argument('--debug',action='store_true', help='Extra debug information')
+    parser.add_argument('--dry_run', action='store_true', help='Do not update documents, just count them')
+    parser.add_argument('--batch_size', action='store', type=int, default=100, help='Fields renamed per update')
     parser.add_argument('fields', help="Fields to replace")
 
     args = parser.parse_args()
@@ -58,13 +52,10 @@ def main():
         credentials=config['MONGODB_CREDENTIALS'],
         connect_db=True
     )
-    incoming_col = db_lnk.db.get_collection('place')
-
-    if args.verbose:
-        logging.info("Getting ids...")
+    place_cols = [db_lnk.db.get_collection(config[f"{group}_col_prefix"]) for group in ('outsiders', 'minors')]
 
     for ntp_id in (args.id, args.ini, args.fin):
-        if ntp_id is not None and not ntp.check_ntp_id(ntp_id):
+        if ntp_id is not None and not nu.check_ntp_id(ntp_id):
             logging.error(f'{ntp_id} is not a valid ntp id')
             sys.exit()
 
@@ -78,24 +69,82 @@ def main():
             query.append({'_id':{'$lte': args.fin}})
         query = {'$and': query}
 
-    with open(args.fields, "r") as fields_file:
+    fields = read_fields(args.fields)
+    logging.info(f"{len(fields)} fields to replace")
+
+    for incoming_col in place_cols:
+        if args.dry_run:
+            for (old, new), counts in zip(fields, count_fields(incoming_col, fields, query)):
+                logging.info(
+                    f"{incoming_col.name}: {old} -> {new} {counts['old']} documents "
+                    f"({counts['both']} with new {new}, no update) (--dry_run)"
+                )
+            continue
+        for pos in range(0, len(fields), args.batch_size):
+            batch = fields[pos:pos + args.batch_size]
+            logging.info(f"{incoming_col.name}: processing {batch[0][0]} ... {batch[-1][0]}")
+            result = incoming_col.update_many(
+                {'$and': [query, get_fields_filter(batch)]},
+                get_fields_pipeline(batch)
+            )
+            logging.info(f"{incoming_col.name}: {result.matched_count} matched, {result.modified_count} modified")
+
+
+def read_fields(fields_file_name):
+    ''' List of (old, new) field names, tab separated'''
+    fields = []
+    with open(fields_file_name, "r") as fields_file:
         for line in fields_file:
+            if not line.strip():
+                continue
             old, new = line.strip().split('\t')
-            logging.info(f"Processing {old} -> {new}")
-            for doc in incoming_col.find({old : {'$exists': 1}}):
-                logging.info(f"{doc['_id']}: Found old {old}:'{doc[old]}'")
-                if new in doc and doc[new]:
-                    logging.info(f"{doc['_id']}: Found new {new}='{doc[new]}', no update")
-                    incoming_col.update_one(
-                        {'_id': doc['_id']},
-                        {'$unset': {old: 1}}
-                    )
-                else:
-                    incoming_col.update_one(
-                        {'_id': doc['_id']},
-                        {'$set': {new: doc[old]}, '$unset': {old: 1}}
-                    )
-
+            fields.append((old, new))
+    return fields
+
+
+def get_fields_filter(fields):
+    ''' Documents having any of the old fields'''
+    return {'$or': [{old: {'$exists': 1}} for old, _ in fields]}
+
+
+def get_fields_pipeline(fields):
+    ''' Update pipeline replacing old fields by new ones, in order. Values
+        already at new fields are kept, and old fields are removed'''
+    pipeline = []
+    for old, new in fields:
+        pipeline.append({'$set': {new: {
+            '$cond': [
+                {'$eq': [{'$type': f"${old}"}, 'missing']},
+                f"${new}",
+                {'$ifNull': [f"${new}", f"${old}"]}
+            ]
+        }}})
+        pipeline.append({'$unset': old})
+    return pipeline
+
+
+def count_fields(incoming_col, fields, query):
+    ''' Number of documents with each old field, and with both old and new
+        fields, from a single $facet aggregation'''
+    facets = {}
+    for pos, (old, new) in enumerate(fields):
+        facets[f"field{pos}"] = [
+            {'$match': {old: {'$exists': 1}}},
+            {'$group': {
+                '_id': None,
+                'old': {'$sum': 1},
+                'both': {'$sum': {'$cond': [{'$eq': [{'$ifNull': [f"${new}", None]}, None]}, 0, 1]}}
+            }}
+        ]
+    result = next(incoming_col.aggregate([
+        {'$match': {'$and': [query, get_fields_filter(fields)]}},
+        {'$facet': facets}
+    ], allowDiskUse=True), {})
+    counts = []
+    for pos in range(len(fields)):
+        facet = result.get(f"field{pos}") or [{'old': 0, 'both': 0}]
+        counts.append({'old': facet[0]['old'], 'both': facet[0]['both']})
+    return counts
 
 
 if __name__ == "__main__":
@@ -1,18 +1,16 @@
 #!/usr/bin/env python
 # coding: utf-8
 ''' Script to prepare a collection of most recent data for each tender (PLACE)
-    usage: clean_place.py [-h] [--ini INI] [--fin FIN] [--id ID]
+    usage: clean_place.py [-h] [--ini INI] [--fin FIN] [--id ID] [--group GROUP] [--drop] [--batch_size BATCH_SIZE]
 '''
 import sys
 import argparse
 import logging
-import os
-import time
 from datetime import datetime
 from yaml import load, CLoader
-from nextplib import ntp_entry as ntp
-#from nextplib import ntp_storage as ntpst
+from nextplib import ntp_utils as nu, ntp_versions, ntp_indexes
 from mmb_data.mongo_db_connect import Mongo_db
+from mmb_data.mongo_db_bulk_write import MongoDBBulkWrite, CTS
 
 
 def print_stats(lits):
@@ -37,6 +35,7 @@ def main():
     parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
     parser.add_argument('--debug',action='store_true', help='Extra debug information')
     parser.add_argument('--drop',action='store_true', help='Delete previous data')
+    parser.add_argument('--batch_size', action='store', type=int, default=1000, help='Place ids per bulk write')
 
     args = parser.parse_args()
     # Setup logging
@@ -67,19 +66,25 @@ def main():
     except KeyError as e:
         logging.error(e)
         sys.exit()
+    version_index = ntp_versions.VersionIndex(db_lnk.db, clean_col.name, args.batch_size)
 
     for ntp_id in (args.id, args.ini, args.fin):
-        if ntp_id is not None and not ntp.check_ntp_id(ntp_id):
+        if ntp_id is not None and not nu.check_ntp_id(ntp_id):
             logging.error(f'{ntp_id} is not a valid ntp id')
             sys.exit()
 
     if args.drop:
         clean_col.delete_many({})
+        version_index.col.drop()
         logging.info("Deleting existing data")
+    version_index.ensure_indexes()
+    # Versions of the selected place ids are looked up by id
+    ntp_indexes.ensure_indexes(incoming_col, 'place_raw')
 
+    query = None
     if args.id is not None:
         query = {'_id': args.id}
-    else:
+    elif args.ini is not None or args.fin is not None:
         query = [{'id':{'$exists':1}}]
         if args.ini is not None:
             query.append({'_id':{'$gte': args.ini}})
@@ -87,105 +92,126 @@ def main():
             query.append({'_id':{'$lte': args.fin}})
         query = {'$and': query}
 
-    chunk_size = 100000
-    current = 0
-    finished = False
     logging.info("Grouping documents according to place id")
-    LICS = {}
     STATS = {}
-    while not finished:
-        logging.info(f"Processing {current} to {current + chunk_size}")
-        PLACE_IDS = [
-            result['id']
-            for result in incoming_col.find(
-                query,
-                projection={'id':1, '_id':0},
-                skip=current,
-                limit= chunk_size
-                )
-        ]
-        finished = not PLACE_IDS
-        if finished:
-            continue
-        current += chunk_size
-
-        for doc in incoming_col.aggregate([
-            {'$match' : {'$and':[{'id': {'$in': PLACE_IDS}}, {'data_model':'v2023'}]}},
-            {
-            '$group':
-                {
-                    '_id':'$id',
-                    'versions': {'$addToSet': {'_id':"$_id", 'updated': "$updated"}}
-                }
-            }], allowDiskUse=True):
-            place_id = os.path.basename(doc['_id'])
-            LICS[place_id] = doc['versions']
-            if not doc['versions']:
-                logging.warning(f"no documents found with v2023 data model for {doc['_id']}")
-            if len(doc['versions']) in STATS:
-                STATS[len(doc['versions'])] += 1
-            else:
-                STATS[len(doc['versions'])] = 1
-            found_ok = True
-
-
-    logging.info(f"Found versioned entries: {[str(k) + ':' + str(v) for k,v in sorted (STATS.items())]}")
-
-    if (args.drop:
-        logging.info("Dropping patch collection")
-        clean_col.delete_many({})
-
-    logging.info(f"Start processing, {len(LICS)} place ids")
     num_ids = 0
-    num_new = 0
-
-    for place_id in LICS:
+    clean_bulk = MongoDBBulkWrite(clean_col, CTS['UPSERT'], args.batch_size)
+    pending = []
+    for doc in incoming_col.aggregate(get_groups_pipeline(incoming_col, query), allowDiskUse=True):
+        num_versions = len(doc['versions'])
+        STATS[num_versions] = STATS.get(num_versions, 0) + 1
         if args.verbose:
-            logging.info(f"Processing place_id {place_id} with {len(LICS[place_id]) - 1} updates ")
-        update_dates =  []
-        for ntp_doc in LICS[place_id]:
-            logging.debug(ntp_doc)
-            if isinstance(ntp_doc['updated'], list):
-                for upd_date in ntp_doc['updated']:
-                    update_dates.append([upd_date, ntp_doc['_id']])
-            else:
-                update_dates.append([ntp_doc['updated'], ntp_doc['_id']])
-        last_update = ''
-        last_doc = ''
-        old_ids = set()
-        for ind, upd_item in enumerate(update_dates):
-            upd_date, upd_id = upd_item
+            logging.info(f"Processing place_id {doc['_id']} with {num_versions - 1} updates ")
+        pending.append(get_versions(doc['versions']))
+        if len(pending) >= args.batch_size:
+            commit_versions(incoming_col, clean_bulk, pending, version_index)
+            pending = []
+        num_ids += 1
+    commit_versions(incoming_col, clean_bulk, pending, version_index)
+    clean_bulk.commit_any_data()
+    version_index.flush()
+
+    logging.info(f"Found versioned entries: {[str(k) + ':' + str(v) for k,v in sorted (STATS.items())]}")
+    logging.info(f"Processed {num_ids} entries, added {num_ids} unique documents")
+
+
+def get_groups_pipeline(incoming_col, query=None):
+    ''' Aggregation pipeline grouping the v2023 versions ({_id, updated}) of
+        each place id. Without query the whole collection is grouped in a
+        single $group, otherwise query selects place ids and all their versions
+        (also those out of query) are found with a $lookup on the id index'''
+    if query is None:
+        return [
+            {'$match': {'id': {'$exists': 1}, 'data_model':'v2023'}},
+            {'$group': {
+                '_id':'$id',
+                'versions': {'$addToSet': {'_id':"$_id", 'updated': "$updated"}}
+            }}
+        ]
+    return [
+        {'$match': {'$and':[query, {'id': {'$exists': 1}, 'data_model':'v2023'}]}},
+        {'$group': {'_id': '$id'}},
+        # localField/foreignField with pipeline requires MongoDB 5.0
+        {'$lookup': {
+            'from': incoming_col.name,
+            'localField': '_id',
+            'foreignField': 'id',
+            'pipeline': [
+                {'$match': {'data_model':'v2023'}},
+                {'$project': {'_id': 1, 'updated': 1}}
+            ],
+            'as': 'versions'
+        }}
+    ]
+
+
+def get_versions(versions):
+    ''' Final document id, list of [update date, ntp id] and obsolete ids for
+        the versions of a place id'''
+    update_dates = []
+    for ntp_doc in versions:
+        logging.debug(ntp_doc)
+        updates = ntp_doc.get('updated')
+        if not isinstance(updates, list):
+            updates = [updates]
+        for upd_date in updates:
+            if upd_date is None:
+                continue
             if isinstance(upd_date, datetime):
                 upd_date = upd_date.strftime('%Y-%m-%d %H:%M:%S')
-            update_dates[ind] = [upd_date[0:19], upd_id]
-            logging.debug(f"{upd_id} {upd_date}")
-            if upd_date > last_update:
-                last_update = upd_date
-                last_doc = upd_id
-        logging.debug(f"{place_id} {last_doc} {last_update}")
-        for item in update_dates:
-            upd_date, upd_id = upd_item
-            if upd_id == last_doc:
-                continue
-            old_ids.add(upd_id)
-
-        final_doc = ntp.NtpEntry()
-        final_doc.load_from_db(incoming_col, last_doc)
-        final_doc.data['updates_dates_list'] = update_dates
-        final_doc.commit_to_db(clean_col)
+            update_dates.append([upd_date[0:19], ntp_doc['_id']])
+    last_update = ''
+    last_doc = versions[0]['_id']
+    for upd_date, upd_id in update_dates:
+        logging.debug(f"{upd_id} {upd_date}")
+        if upd_date > last_update:
+            last_update = upd_date
+            last_doc = upd_id
+    old_ids = sorted(set(ntp_doc['_id'] for ntp_doc in versions).difference([last_doc]))
+    return last_doc, update_dates, old_ids
+
+
+def commit_versions(incoming_col, clean_bulk, pending, version_index):
+    ''' Store final documents (read in a single query), obsolete pointers
+        and version chains for a batch of place ids'''
+    if not pending:
+        return
+    final_docs = {
+        doc['_id']: doc
+        for doc in incoming_col.find({'_id': {'$in': [last_doc for last_doc, _, _ in pending]}})
+    }
+    for last_doc, update_dates, old_ids in pending:
+        if last_doc not in final_docs:
+            logging.error(f"Final document {last_doc} not found")
+            continue
+        final_data = final_docs[last_doc]
+        final_data['updates_dates_list'] = update_dates
+        for key in ('obsolete_version', 'updated_to'):
+            final_data.pop(key, None)
+        # Final document replaces any previous contents
+        clean_bulk.append(
+            {'_id': last_doc},
+            [{'$replaceWith': {'$literal': final_data}}]
+        )
+        clean_bulk.commit_data_if_full()
         for ntp_id in old_ids:
-            clean_col.replace_one(
+            # Obsolete versions keep only the pointer to the final document
+            clean_bulk.append(
                 {'_id': ntp_id},
-                {
-                    'id': final_doc.data['id'],
+                [{'$replaceWith': {'$literal': {
+                    '_id': ntp_id,
+                    'id': final_data['id'],
                     'obsolete_version': True,
-                    'updated_to': final_doc.data['_id']
-                },
-                upsert=True
+                    'updated_to': last_doc
+                }}}]
             )
-        num_new += 1
-        num_ids += 1
-    logging.info(f"Processed {num_ids} entries, added {num_new} unique documents")
+            clean_bulk.commit_data_if_full()
+        version_index.store(
+            final_data['id'],
+            last_doc,
+            old_ids,
+            [upd_date for upd_date, upd_id in update_dates if upd_id == last_doc]
+        )
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,22 @@
 #!/usr/bin/env python
 # coding: utf-8
 ''' Script to fix Entidad_Adjudicadora/ID to all string
-    usage: fix_contracter_ids.py [-h] [--ini INI] [--fin FIN] [--id ID]
+    usage: fix_contracter_ids.py [-h] [--ini INI] [--fin FIN] [--id ID] [--dry_run]
+
+Values are normalized server-side with a pipeline update, touching only
+documents where Entidad_Adjudicadora/ID is not a list of strings
 '''
 import sys
 import argparse
 import logging
-import os
-import time
 from yaml import load, CLoader
+from nextplib import ntp_utils as nu
 from mmb_data.mongo_db_connect import Mongo_db
 
+ID_FIELD = 'Entidad_Adjudicadora/ID'
+# BSON types converted with $toString
+SCALAR_TYPES = ['string', 'int', 'long', 'double', 'decimal', 'bool', 'date', 'objectId']
+
 def main():
     ''' Main '''
     parser = argparse.ArgumentParser(description='Fix contracter ids')
@@ -20,6 +26,7 @@ def main():
     parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default;secrets.yml)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
     parser.add_argument('--debug',action='store_true', help='Extra debug information')
+    parser.add_argument('--dry_run', action='store_true', help='Do not update documents, just count them')
 
     args = parser.parse_args()
     # Setup logging
@@ -48,7 +55,7 @@ def main():
         logging.info("Getting ids...")
 
     for ntp_id in (args.id, args.ini, args.fin):
-        if ntp_id is not None and not ntp.check_ntp_id(ntp_id):
+        if ntp_id is not None and not nu.check_ntp_id(ntp_id):
             logging.error(f'{ntp_id} is not a valid ntp id')
             sys.exit()
 
@@ -66,27 +73,91 @@ def main():
         incoming_col = db_lnk.db.get_collection(config[f"{col}_col_prefix"])
         logging.info(f"Processing {col} collection")
         logging.debug(incoming_col)
-        for doc in incoming_col.find({'Entidad_Adjudicadora/ID': {'$exists': 1}}, projection={'Entidad_Adjudicadora/ID':1}):
-            logging.debug(doc['Entidad_Adjudicadora/ID'])
-            if not doc['Entidad_Adjudicadora/ID']:
-                logging.warning(f"Empty Entidad_Adjudicadora/ID in {doc['_id']}")
-                continue
-            if not isinstance(doc['Entidad_Adjudicadora/ID'], list):
-                new_ids = [str(doc['Entidad_Adjudicadora/ID'])]
-
-            elif len(str(doc['Entidad_Adjudicadora/ID'][0])) == 1:
-                # Fix from single id
-                new_ids = [''.join(doc['Entidad_Adjudicadora/ID'])]
-            elif len(doc['Entidad_Adjudicadora/ID']) > 1:
-                new_ids = [str(x) for x in doc['Entidad_Adjudicadora/ID']]
-            else:
-                new_ids = [str(doc['Entidad_Adjudicadora/ID'][0])]
-            logging.debug(new_ids)
-            incoming_col.update_one(
-                {'_id': doc['_id']},
-                {'$set': {'Entidad_Adjudicadora/ID': new_ids}}
-            )
+        fix_query = {'$and': [query, {'$expr': get_non_conforming(ID_FIELD)}]}
+        if args.dry_run:
+            num_docs = incoming_col.count_documents(fix_query)
+            logging.info(f"{num_docs} documents to fix at {incoming_col.name} (--dry_run)")
+            continue
+        result = incoming_col.update_many(fix_query, get_fix_pipeline(ID_FIELD))
+        logging.info(f"{result.matched_count} matched, {result.modified_count} modified at {incoming_col.name}")
+        # Verification
+        num_left = incoming_col.count_documents(fix_query)
+        if num_left:
+            logging.warning(f"{num_left} documents at {incoming_col.name} still have non conforming {ID_FIELD}")
+        else:
+            logging.info(f"All {ID_FIELD} at {incoming_col.name} are lists of strings")
+
+
+def get_non_conforming(field):
+    ''' Expression matching non empty values of field that are not a list of
+        strings, or that are ids split in single chars'''
+    value = f"${field}"
+    # Nested $cond, so array operators only see arrays of strings
+    return {'$and': [
+        {'$not': [{'$in': [{'$type': value}, ['missing', 'null']]}]},
+        {'$not': [{'$in': [value, {'$literal': ['', [], 0, False]}]}]},
+        {'$cond': [
+            {'$ne': [{'$type': value}, 'array']},
+            True,
+            {'$cond': [
+                {'$allElementsTrue': [
+                    {'$map': {'input': value, 'in': {'$eq': [{'$type': '$$this'}, 'string']}}}
+                ]},
+                {'$cond': [
+                    {'$gt': [{'$size': value}, 1]},
+                    {'$eq': [{'$strLenCP': {'$arrayElemAt': [value, 0]}}, 1]},
+                    False
+                ]},
+                True
+            ]}
+        ]}
+    ]}
+
+
+def get_string_value(value):
+    ''' Expression converting value to string if it is a scalar, other values
+        ($toString fails on objects and arrays) are kept as they are'''
+    return {'$cond': [
+        {'$in': [{'$type': value}, SCALAR_TYPES]},
+        {'$toString': value},
+        value
+    ]}
+
 
+def get_fix_pipeline(field):
+    ''' Update pipeline converting field to a list of strings. Scalars are
+        wrapped, lists of single chars joined, other lists converted to strings.
+        Objects, and objects or arrays within lists, are left untouched'''
+    value = f"${field}"
+    first = {'$arrayElemAt': [value, 0]}
+    return [{'$set': {field: {'$switch': {
+        'branches': [
+            {
+                'case': {'$in': [{'$type': value}, SCALAR_TYPES]},
+                'then': [{'$toString': value}]
+            },
+            {
+                'case': {'$ne': [{'$type': value}, 'array']},
+                'then': value
+            },
+            {
+                # Fix from single id, only lists of strings are joined
+                'case': {'$cond': [
+                    {'$allElementsTrue': [
+                        {'$map': {'input': value, 'in': {'$eq': [{'$type': '$$this'}, 'string']}}}
+                    ]},
+                    {'$eq': [{'$strLenCP': {'$ifNull': [first, '']}}, 1]},
+                    False
+                ]},
+                'then': [{'$reduce': {
+                    'input': value,
+                    'initialValue': '',
+                    'in': {'$concat': ['$$value', '$$this']}
+                }}]
+            }
+        ],
+        'default': {'$map': {'input': value, 'in': get_string_value('$$this')}}
+    }}}}]
 
 if __name__ == "__main__":
     main()
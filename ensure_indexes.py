@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+''' Script to create the MongoDB indexes required by the ETL scripts
+    usage: ensure_indexes.py [-h] [--config CONFIG] [-v] [--debug] [--dry_run]
+
+Ensure MongoDB indexes
+
+options:
+  -h, --help       show this help message and exit
+  --config CONFIG  Configuration file (default: secrets.yml)
+  -v, --verbose    Extra progress information
+  --debug          Extra debug information
+  --dry_run        Do not create indexes, just list missing ones
+'''
+import sys
+import argparse
+import logging
+from yaml import load, CLoader
+from nextplib import ntp_indexes
+from mmb_data.mongo_db_connect import Mongo_db
+
+def main():
+    ''' Main '''
+    parser = argparse.ArgumentParser(description='Ensure MongoDB indexes')
+    parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default:secrets.yml)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
+    parser.add_argument('--debug',action='store_true', help='Extra debug information')
+    parser.add_argument('--dry_run', action='store_true', help='Do not create indexes, just list missing ones')
+
+    args = parser.parse_args()
+    # Setup logging
+    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
+    if args.debug:
+        logging.getLogger().setLevel(10)
+    else:
+        logging.getLogger().setLevel(20)
+
+    # Config file
+    with open(args.config, 'r')  as config_file:
+        config = load(config_file, Loader=CLoader)
+
+    logging.info(f"Connecting to MongoDB at {config['MONGODB_HOST']}")
+
+    db_lnk = Mongo_db(
+        config['MONGODB_HOST'],
+        config['MONGODB_DB'],
+        False,
+        config['MONGODB_AUTH'],
+        credentials=config['MONGODB_CREDENTIALS'],
+        connect_db=True
+    )
+
+    num_created = 0
+    for col_name, kind in ntp_indexes.get_collections(config):
+        col = db_lnk.db.get_collection(col_name)
+        if args.verbose:
+            logging.info(f"Checking {col_name} ({kind})")
+        created = ntp_indexes.ensure_indexes(col, kind, dry_run=args.dry_run)
+        if args.dry_run:
+            for keys in created:
+                logging.info(f"Missing index {keys} on {col_name} (--dry_run)")
+        num_created += len(created)
+
+    if args.dry_run:
+        logging.info(f"{num_created} indexes missing")
+    else:
+        logging.info(f"{num_created} indexes created")
+
+if __name__ == "__main__":
+    main()
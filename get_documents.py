@@ -5,7 +5,7 @@
                                 [--where {disk,gridfs,swift}] [--folder FOLDER]
                                 [--config CONFIG] [--debug] [--scan_only] [--delay DELAY]
                                 [--container] [--allow_redirects] [--skip_early]
-                                [--skip_bad_servers] [--group GROUP]
+                                [--skip_bad_servers] [--group GROUP] [--storage STORAGE]
     Download documents
 
     options:
@@ -26,6 +26,7 @@
         --skip_early Skip immediately if any file for the corresponding field is already stored
         --skip_bad_servers Skip servers with usual timeouts or missing documents
         --group GROUP insiders|outsiders|minors
+        --storage STORAGE Storage URI (local folder|gridfs:[bucket]|container@swift:folder), overrides --where
 '''
 import sys
 import argparse
@@ -33,8 +34,7 @@ import logging
 import os
 import time
 from yaml import load, CLoader
-import swiftclient as sw
-from nextplib import ntp_entry as ntp, ntp_storage as ntpst, ntp_utils as nu, ntp_constants as cts
+from nextplib import ntp_entry as ntp, ntp_storage as ntpst, ntp_utils as nu, ntp_constants as cts, ntp_indexes
 from mmb_data.mongo_db_connect import Mongo_db
 
 def main():
@@ -46,6 +46,7 @@ def main():
     parser.add_argument('--id', action='store', help='Selected document id')
     parser.add_argument('--where', action='store', default='disk', choices=['disk', 'gridfs', 'swift'], help='Selected storage (disk|gridfs|swift)')
     parser.add_argument('--folder', action='store', help='Selected Disk/Swift folder')
+    parser.add_argument('--storage', action='store', help='Storage URI (local folder|gridfs:[bucket]|container@swift:folder), overrides --where')
     parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default:secrets.yml)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
     parser.add_argument('--debug',action='store_true', help='Extra debug information')
@@ -90,7 +91,10 @@ def main():
         if args.verbose:
             logging.info("Connecting to storage...")
 
-        if args.where == 'disk':
+        factory = ntpst.StorageFactory(config, db_lnk=db_lnk)
+        if args.storage is not None:
+            storage_uri = args.storage
+        elif args.where == 'disk':
             if args.folder is None:
                 data_folder = config['TMPDIR']
             else:
@@ -98,36 +102,24 @@ def main():
 
             if not os.path.isdir(data_folder):
                 try:
-                    os.mkdir((args.folder))
+                    os.mkdir(data_folder)
                 except:
-                    sys.exit("Error creating {data_folder}")
+                    sys.exit(f"Error creating {data_folder}")
                 logging.info(f"{data_folder} non existent, created")
-
-            storage = ntpst.NtpStorageDisk(data_dir=data_folder)
-            logging.info(f"Using disk storage at {data_folder}")
+            storage_uri = data_folder
 
         elif args.where == 'gridfs':
-            logging.info(f"Using GridFS storage at {config['MONGODB_HOST']}")
-            storage = ntpst.NtpStorageGridFs(gridfs_obj=db_lnk.get_gfs(config['documents_col']))
+            storage_uri = 'gridfs:'
 
         elif args.where == 'swift':
-            logging.info("Using Swift storage")
-            swift_conn = sw.Connection(
-                authurl=config['OS_AUTH_URL'],
-                auth_version=3,
-                os_options={
-                    'auth_type': config['OS_AUTH_TYPE'],
-                    'region_name': config['OS_REGION_NAME'],
-                    'application_credential_id': config['OS_APPLICATION_CREDENTIAL_ID'],
-                    'application_credential_secret': config['OS_APPLICATION_CREDENTIAL_SECRET'],
-                    'service_project_name': config['OS_PROJECT_NAME']
-                }
-            )
-            storage = ntpst.NtpStorageSwift(
-                swift_connection=swift_conn,
-                swift_container=config['OS_SWIFT_CONTAINER'],
-                swift_prefix=config['OS_SWIFT_DOCUMENTS_FOLDER']
-            )
+            storage_uri = f"@swift:{args.folder or ''}"
+
+        try:
+            storage = factory.get_storage(storage_uri)
+        except (ValueError, KeyError) as err:
+            logging.error(f"Storage not available: {err}")
+            sys.exit(1)
+        logging.info(f"Using {storage.type} storage at {storage_uri}")
     else:
         args.debug = True
         storage = None
@@ -149,6 +141,7 @@ def main():
         if args.fin is not None:
             query.append({'_id':{'$lte': args.fin}})
         query = {'$and': query}
+        ntp_indexes.check_query(incoming_col, query)
 
     num_ids = 0
     last_server = ''
@@ -212,6 +205,8 @@ def main():
                     logging.info(f"{url_field} unavailable, Reason: certificate error")
                 else:
                     logging.warning(f"{url_field} unavailable. Reason: {results[1]}")
+    if storage is not None:
+        storage.close()
     if args.verbose:
         logging.info(f"Processed {num_ids} entries")
 if __name__ == "__main__":
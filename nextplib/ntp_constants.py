@@ -7,8 +7,39 @@ ACCEPTED_DOC_TYPES = (
     'xls', 'xlsm', 'xlsx', 'zip'
 )
 
+# Compression codec per document type (None: stored as is)
+COMPRESSION_POLICY = {
+    '7z': None, 'doc': 'zstd', 'docx': None, 'pdf': 'zstd',
+    'tcq': 'zstd', 'dwg': None, 'odg': None, 'odt': 'zstd',
+    'rar': None, 'rtf': 'zstd', 'txt': 'zstd',
+    'xls': 'zstd', 'xlsm': None, 'xlsx': None, 'zip': None
+}
+COMPRESSION_LEVEL = 3
+# Compressed copy is kept only if smaller by at least this fraction
+COMPRESSION_MIN_SAVING = 0.1
+
 TIMEOUT = 10
 
+# Swift objects larger than SWIFT_SEGMENT_THRESHOLD are stored as Static Large Objects
+SWIFT_SEGMENT_THRESHOLD = 256 * 1024 * 1024
+SWIFT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Max. objects per Swift bulk-delete request, and files per GridFS delete batch
+SWIFT_BULK_DELETE_MAX = 10000
+DELETE_BATCH = 1000
+
+# Default size of local document cache
+CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# Incremental syncs list origin changes from this many seconds before the
+# high-water mark (clock skew and uploads in progress at the previous run)
+SYNC_HWM_MARGIN = 300
+# sync transfers: documents read and waiting to be stored, retries per file
+# and initial backoff (seconds, doubled on each retry)
+SYNC_MAX_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+SYNC_RETRIES = 3
+SYNC_BACKOFF = 1.0
+
 REDIRECT_CODES = (301, 302, 303, 307, 308)
 MAX_REDIRECTS = 30
 
@@ -92,9 +92,13 @@ class NtpEntry:
 
         return self.ntp_order
 
-    def load_from_db(self, col_id,  ntp_id, follow_version=False):
-        ''' Load data from db'''
+    def load_from_db(self, col_id,  ntp_id, follow_version=False, version_index=None):
+        ''' Load data from db. With follow_version, obsolete documents are
+            replaced by their active version, resolved in one lookup if a
+            VersionIndex is given, following updated_to pointers otherwise'''
         try:
+            if follow_version and version_index is not None:
+                ntp_id = version_index.resolve(ntp_id) or ntp_id
             self.data = col_id.find_one({'_id': ntp_id})
             if not self.data:
                 self.data = {}
@@ -102,7 +106,7 @@ class NtpEntry:
             self.ntp_id = ntp_id
             self.ntp_order = nu.parse_ntp_id(ntp_id)
             if follow_version and self.is_obsolete():
-                self.load_from_db(col_id, self.data['updated_to'], follow_version=follow_version)
+                return self.load_from_db(col_id, self.data['updated_to'], follow_version=follow_version)
         except Exception as e:
             logging.error(e)
             return False
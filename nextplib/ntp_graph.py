@@ -0,0 +1,166 @@
+''' Compact in-memory version graphs of place collections '''
+import logging
+import calendar
+from array import array
+from datetime import datetime
+import numpy as np
+from nextplib import ntp_utils as nu
+
+# Code for missing place ids or pointers
+NO_CODE = -1
+
+def get_epoch(update):
+    ''' Epoch seconds (UTC) for an update date, as datetime or YYYY-MM-DD HH:MM:SS'''
+    if isinstance(update, datetime):
+        return calendar.timegm(update.timetuple())
+    return calendar.timegm(datetime.strptime(update[0:19], '%Y-%m-%d %H:%M:%S').timetuple())
+
+class VersionGraph:
+    ''' Versions of a place collection held in NumPy arrays, sorted by ntp order:
+            orders    ntp order of each version (int64, from parse_ntp_id)
+            places    place id code (int32, place ids interned at place_ids)
+            obsolete  obsolete_version flag (bool)
+            pointers  ntp order of updated_to (int64, NO_CODE if missing)
+        and, if loaded, update dates as epoch seconds (int64) in update_dates,
+        with the position of their version at update_versions.
+        Versions are added with add() and arrays built with freeze()'''
+    def __init__(self):
+        self.place_ids = []
+        self.place_codes = {}
+        self._buffers = {
+            'orders': array('q'),
+            'places': array('q'),
+            'obsolete': array('b'),
+            'pointers': array('q'),
+            'update_dates': array('q'),
+            'update_versions': array('q')
+        }
+        self.orders = None
+        self.places = None
+        self.obsolete = None
+        self.pointers = None
+        self.update_dates = None
+        self.update_versions = None
+
+    def __len__(self):
+        if self.orders is None:
+            return len(self._buffers['orders'])
+        return len(self.orders)
+
+    def get_place_code(self, place_id):
+        ''' Interned code for place_id, NO_CODE if unknown'''
+        return self.place_codes.get(place_id, NO_CODE)
+
+    def add(self, ntp_id, place_id, obsolete=False, updated_to=None, updated=None):
+        ''' Add a version. updated is a date or list of dates'''
+        if place_id is None:
+            code = NO_CODE
+        else:
+            code = self.place_codes.setdefault(place_id, len(self.place_ids))
+            if code == len(self.place_ids):
+                self.place_ids.append(place_id)
+        buffers = self._buffers
+        buffers['orders'].append(nu.parse_ntp_id(ntp_id))
+        buffers['places'].append(code)
+        buffers['obsolete'].append(bool(obsolete))
+        if updated_to and nu.check_ntp_id(updated_to):
+            buffers['pointers'].append(nu.parse_ntp_id(updated_to))
+        else:
+            buffers['pointers'].append(NO_CODE)
+        if updated:
+            if not isinstance(updated, list):
+                updated = [updated]
+            for update in updated:
+                buffers['update_dates'].append(get_epoch(update))
+                buffers['update_versions'].append(len(buffers['orders']) - 1)
+
+    def freeze(self):
+        ''' Build NumPy arrays from added versions, sorted by ntp order'''
+        buffers = self._buffers
+        orders = np.frombuffer(buffers['orders'], dtype=np.int64)
+        sort_order = np.argsort(orders, kind='stable')
+        self.orders = orders[sort_order]
+        self.places = np.frombuffer(buffers['places'], dtype=np.int64)[sort_order].astype(np.int32)
+        self.obsolete = np.frombuffer(buffers['obsolete'], dtype=np.int8)[sort_order].astype(bool)
+        self.pointers = np.frombuffer(buffers['pointers'], dtype=np.int64)[sort_order]
+        # update_versions point to positions before sorting
+        new_positions = np.empty_like(sort_order)
+        new_positions[sort_order] = np.arange(len(sort_order))
+        self.update_dates = np.frombuffer(buffers['update_dates'], dtype=np.int64).copy()
+        self.update_versions = new_positions[np.frombuffer(buffers['update_versions'], dtype=np.int64)]
+        # Buffers are released once the arrays above are built
+        self._buffers = {key: array(buffer.typecode) for key, buffer in buffers.items()}
+        return self
+
+    @classmethod
+    def from_collection(cls, col, query=None, updates=False, batch_size=10000):
+        ''' Load versions in query from col, reading only _id, id,
+            obsolete_version, updated_to (and updated if updates) in _id order'''
+        graph = cls()
+        projection = {'_id': 1, 'id': 1, 'obsolete_version': 1, 'updated_to': 1}
+        if updates:
+            projection['updated'] = 1
+        for doc in col.find(query or {}, projection=projection, sort=[('_id', 1)], batch_size=batch_size):
+            graph.add(
+                doc['_id'],
+                doc.get('id'),
+                obsolete=doc.get('obsolete_version'),
+                updated_to=doc.get('updated_to'),
+                updated=doc.get('updated')
+            )
+            if len(graph) % 1000000 == 0:
+                logging.info(f"{len(graph)} versions loaded from {col.name}")
+        return graph.freeze()
+
+    def find(self, ntp_orders):
+        ''' Positions of ntp_orders in the graph, NO_CODE if not present'''
+        ntp_orders = np.asarray(ntp_orders, dtype=np.int64)
+        if not len(self.orders):
+            return np.full(len(ntp_orders), NO_CODE, dtype=np.int64)
+        positions = np.searchsorted(self.orders, ntp_orders)
+        positions[positions == len(self.orders)] = 0
+        found = self.orders[positions] == ntp_orders
+        return np.where(found, positions, NO_CODE)
+
+    def gaps(self, ini_order=None):
+        ''' ntp orders missing between ini_order (default: first one) and the last order'''
+        if not len(self.orders):
+            return np.empty(0, dtype=np.int64)
+        if ini_order is None:
+            ini_order = self.orders[0]
+        return np.setdiff1d(np.arange(ini_order, self.orders[-1] + 1, dtype=np.int64), self.orders)
+
+    def active_versions(self):
+        ''' Active ntp order of each place code (the last active one, NO_CODE if
+            none), and number of active versions per place code'''
+        active = np.flatnonzero(~self.obsolete & (self.places != NO_CODE))
+        num_active = np.bincount(self.places[active], minlength=len(self.place_ids))
+        active_orders = np.full(len(self.place_ids), NO_CODE, dtype=np.int64)
+        np.maximum.at(active_orders, self.places[active], self.orders[active])
+        return active_orders, num_active
+
+    def groups(self):
+        ''' Generates (place code, positions of its versions in ntp order),
+            grouping by sorting on place codes'''
+        if not len(self.orders):
+            return
+        by_place = np.lexsort((self.orders, self.places))
+        places = self.places[by_place]
+        bounds = np.r_[np.flatnonzero(np.r_[True, places[1:] != places[:-1]]), len(places)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if places[start] != NO_CODE:
+                yield int(places[start]), by_place[start:end]
+
+    def last_updates(self):
+        ''' Latest update date (epoch) of each version, NO_CODE if none'''
+        last = np.full(len(self.orders), NO_CODE, dtype=np.int64)
+        np.maximum.at(last, self.update_versions, self.update_dates)
+        return last
+
+    def memory_usage(self):
+        ''' Bytes held by graph arrays (not including interned place ids)'''
+        return sum(
+            values.nbytes
+            for values in (self.orders, self.places, self.obsolete, self.pointers, self.update_dates, self.update_versions)
+            if values is not None
+        )
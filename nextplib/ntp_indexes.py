@@ -0,0 +1,123 @@
+''' Indexes supporting the ETL queries, and checks of query plans '''
+import logging
+from pymongo.errors import OperationFailure
+
+# Index specs per collection kind, as (keys, options). Indexes are matched by
+# keys, names are the MongoDB defaults
+INDEX_SPECS = {
+    # place, place_menores
+    'place': [
+        # Versions of a place id (get_versions, get_active_version, find_previous_doc)
+        ([('id', 1), ('obsolete_version', 1)], {}),
+        # Active or obsolete documents in _id ranges (get_documents, purge_documents)
+        ([('obsolete_version', 1), ('_id', 1)], {}),
+    ],
+    # place_raw, place_menores_raw
+    'place_raw': [
+        # Versions of a place id (clean_place $lookup)
+        ([('id', 1)], {}),
+    ],
+    # Version chains index (ntp_versions)
+    'versions': [
+        ([('ids', 1)], {}),
+    ],
+    # GridFS buckets (downloadedDocuments, downloadedDocuments_backup)
+    'gridfs_files': [
+        ([('filename', 1), ('uploadDate', 1)], {}),
+    ],
+    'gridfs_chunks': [
+        ([('files_id', 1), ('n', 1)], {'unique': True}),
+    ],
+    'gridfs_deleted': [
+        ([('deleted', 1)], {}),
+    ],
+    # Sync manifest entries (ntp_sync)
+    'sync_manifest': [
+        ([('pair', 1), ('name', 1)], {'unique': True}),
+    ],
+}
+
+def get_collections(config):
+    ''' Collection names and kinds of the indexes required by the ETL scripts,
+        as [(name, kind)], from configuration'''
+    collections = []
+    for group in ('insiders', 'outsiders', 'minors'):
+        col_name = config.get(f"{group}_col_prefix")
+        if col_name is None or (col_name, 'place') in collections:
+            continue
+        collections.append((col_name, 'place'))
+        collections.append((f"{col_name}_raw", 'place_raw'))
+        collections.append((f"{col_name}_versions", 'versions'))
+    for bucket_key in ('documents_col', 'documents_backup_col'):
+        if bucket_key not in config:
+            continue
+        for suffix in ('files', 'chunks', 'deleted'):
+            collections.append((f"{config[bucket_key]}.{suffix}", f"gridfs_{suffix}"))
+    collections.append((config.get('sync_manifest_col', 'syncManifest'), 'sync_manifest'))
+    return collections
+
+def get_index_keys(keys):
+    ''' Normalized index keys, servers may report orders as floats'''
+    return [
+        (field, order if isinstance(order, str) else int(order))
+        for field, order in keys
+    ]
+
+def missing_indexes(col, kind):
+    ''' Index specs of kind not present at col'''
+    existing = [
+        get_index_keys(index['key'])
+        for index in col.index_information().values()
+    ]
+    return [
+        (keys, options)
+        for keys, options in INDEX_SPECS[kind]
+        if get_index_keys(keys) not in existing
+    ]
+
+def ensure_indexes(col, kind, dry_run=False):
+    ''' Create missing indexes of kind at col, returns list of keys created
+        (or to create with dry_run)'''
+    created = []
+    for keys, options in missing_indexes(col, kind):
+        if not dry_run:
+            logging.info(f"Creating index {keys} on {col.name}")
+            col.create_index(keys, **options)
+        created.append(keys)
+    return created
+
+def get_plan_stages(plan):
+    ''' All stage names found in an explain plan'''
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += get_plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += get_plan_stages(value)
+    return stages
+
+def check_query(col, query, sort=None):
+    ''' Warn if query (and sort) on col is not supported by any index. Only
+        the query planner is run (explain with queryPlanner verbosity), so
+        the query is not executed. Returns True if an index is used'''
+    command = {'find': col.name, 'filter': query}
+    if sort is not None:
+        command['sort'] = dict(sort)
+    try:
+        explain = col.database.command('explain', command, verbosity='queryPlanner')
+    except OperationFailure as err:
+        logging.warning(f"Unable to check query plan on {col.name}: {err}")
+        return True
+    stages = get_plan_stages(explain['queryPlanner']['winningPlan'])
+    if 'COLLSCAN' in stages:
+        logging.warning(
+            f"Query {query} on {col.name} is not supported by any index (COLLSCAN), "
+            "run ensure_indexes.py"
+        )
+        return False
+    if sort is not None and 'SORT' in stages:
+        logging.warning(f"Sort {sort} on {col.name} is not supported by any index (in-memory SORT)")
+    return True
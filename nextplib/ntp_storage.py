@@ -1,13 +1,45 @@
 ''' Classes NtoStorage '''
 import sys
+import io
 import os.path
+import shutil
+import hashlib
+import tempfile
+import mmap
 import logging
 import re
+import json
+import time
+import itertools
+import threading
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 from os.path import join as opj
+from urllib.parse import parse_qsl, quote
+from pymongo import UpdateOne
 from bson.regex import Regex
-from gridfs.errors import CorruptGridFile
+from gridfs import GridFSBucket
+from gridfs.errors import CorruptGridFile, NoFile
 import swiftclient as sw
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from nextplib import ntp_constants as cts, ntp_indexes
+from mmb_data.mongo_db_connect import Mongo_db
+
+# Marker file for NtpStorageDisk folders using the sharded layout
+SHARD_MARKER = '.ntp_sharded'
+# Suffix of NtpStorageCached files keeping the sha256 of cached documents
+CACHE_HASH_SUFFIX = '.sha256'
+# Swift object metadata headers (codec and original size of compressed documents)
+SWIFT_META_PREFIX = 'X-Object-Meta-Ntp-'
+# Content type of compressed Swift objects, so that listings can tell them apart
+ZSTD_CONTENT_TYPE = 'application/zstd'
 
 def is_in_range(ntp_id, id_range):
     ''' Check whether ntp_id is in id_range'''
@@ -22,6 +54,156 @@ def is_in_range(ntp_id, id_range):
         return ntp_id >= id_min
     return id_min <= ntp_id <= id_max
 
+def get_id_prefixes(id_range, max_prefixes=100):
+    ''' Split id_range into the ntp id prefixes (ntp0012...) covering it,
+        using the longest prefixes that keep their number under max_prefixes'''
+    if isinstance(id_range, str):
+        return [id_range]
+    id_min, id_max = id_range if id_range is not None else (None, None)
+    digits_min = (id_min or 'ntp00000000')[3:]
+    digits_max = (id_max or 'ntp99999999')[3:]
+    prefixes = ['ntp']
+    for depth in range(1, len(digits_min) + 1):
+        first = int(digits_min[:depth])
+        last = int(digits_max[:depth])
+        if last - first + 1 > max_prefixes:
+            break
+        prefixes = ['ntp' + str(num).zfill(depth) for num in range(first, last + 1)]
+    return prefixes
+
+def clone_swift_connection(connection):
+    ''' New swift connection with the same credentials, reusing the auth token'''
+    if not connection.token:
+        connection.get_auth()
+    return sw.Connection(
+        authurl=connection.authurl,
+        user=connection.user,
+        key=connection.key,
+        retries=connection.retries,
+        preauthurl=connection.url,
+        preauthtoken=connection.token,
+        auth_version=connection.auth_version,
+        os_options=connection.os_options,
+        cacert=connection.cacert,
+        insecure=connection.insecure,
+        timeout=connection.timeout
+    )
+
+def bounded_map(func, items, max_workers=8, max_pending=None):
+    ''' Apply func to items on a thread pool, keeping at most max_pending
+        tasks queued. Generates (item, result) pairs as tasks complete'''
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for item in items:
+            if len(pending) >= max_pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(func, item)] = item
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), future.result()
+
+def get_filename_range(id_range):
+    ''' MongoDB condition selecting document file names within id_range,
+        None for all files'''
+    if id_range is None:
+        return None
+    if isinstance(id_range, str):
+        return {'$gte': f"{id_range}_", '$lt': f"{id_range}`"}
+    id_min, id_max = id_range
+    condition = {}
+    if id_min is not None:
+        condition['$gte'] = id_min
+    if id_max is not None:
+        # '~' sorts after any field suffix of id_max
+        condition['$lt'] = f"{id_max}~"
+    return condition or None
+
+def iter_batches(items, batch_size):
+    ''' Group items in lists of batch_size'''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_segments(stream, segment_size):
+    ''' Read a file-like object in segment_size pieces'''
+    while True:
+        data = stream.read(segment_size)
+        if not data:
+            break
+        yield data
+
+def get_stream_size(stream):
+    ''' Bytes left to read from a file-like object, None if not known.
+        Known for seekable streams (files, BytesIO, GridOut) and for
+        streams with a length attribute'''
+    try:
+        if stream.seekable():
+            pos = stream.tell()
+            end = stream.seek(0, io.SEEK_END)
+            stream.seek(pos)
+            return end - pos
+    except (AttributeError, OSError, ValueError) as err:
+        logging.debug(err)
+    return getattr(stream, 'length', None)
+
+def fsync_dir(folder):
+    ''' fsync a folder, making renames in it durable'''
+    dir_fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def get_shard_dir(ntp_id):
+    ''' Shard folder (ntp00/12) for ntp_id, empty if ntp_id is not valid'''
+    if not re.match(r'^ntp[0-9]{8}$', ntp_id):
+        return ''
+    return opj(ntp_id[0:5], ntp_id[5:7])
+
+def prefix_in_range(prefix, id_range):
+    ''' Check whether any ntp_id starting with prefix can be in id_range'''
+    if id_range is None:
+        return True
+    if isinstance(id_range, str):
+        return id_range.startswith(prefix)
+    id_min, id_max = id_range
+    return (id_min is None or prefix.ljust(11, '9') >= id_min) and\
+        (id_max is None or prefix.ljust(11, '0') <= id_max)
+
+def get_codec(file_name):
+    ''' Compression codec for file_name according to its document type'''
+    return cts.COMPRESSION_POLICY.get(os.path.splitext(file_name)[1].replace('.', '').lower())
+
+def compress_contents(file_name, contents):
+    ''' Compress contents if the document type policy allows it and the
+        saving is worth. Returns (contents, metadata), metadata is empty
+        for contents kept as is'''
+    codec = get_codec(file_name)
+    if codec is None:
+        return contents, {}
+    if hasattr(contents, 'read'):
+        contents = contents.read()
+    packed = zstandard.ZstdCompressor(level=cts.COMPRESSION_LEVEL).compress(contents)
+    if len(packed) > len(contents) * (1 - cts.COMPRESSION_MIN_SAVING):
+        return contents, {}
+    return packed, {'codec': codec, 'size': len(contents)}
+
+def decompress_contents(contents, codec):
+    ''' Undo compress_contents'''
+    if not codec:
+        return contents
+    if codec != 'zstd' or zstandard is None:
+        raise ValueError(f"Codec {codec} not available")
+    return zstandard.ZstdDecompressor().decompress(contents)
+
 def get_ntpid(file):
     ''' get ntpid from document file name '''
     if '_' not in file:
@@ -29,104 +211,539 @@ def get_ntpid(file):
     ntp_id, field = file.split('_', 1)
     return ntp_id
 
+class HashingReader:
+    ''' File-like wrapper computing the md5 of the data read through it'''
+    def __init__(self, stream):
+        self.stream = stream
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.md5.update(data)
+        return data
+
 class NtpStorage:
     ''' Abstract class to manage alternative storages'''
-    def __init__(self, type_store):
+    def __init__(self, type_store, compression=None):
         self.type = type_store
+        if compression is not None and compression != 'zstd':
+            raise ValueError(f"Compression {compression} not supported")
+        if compression is not None and zstandard is None:
+            raise ValueError("Compression requires the zstandard module")
+        self.compression = compression
 
     def get_ntpid(self, file):
         ntp_id, field = file.split('_', 1)
         return ntp_id
 
+    def file_open(self, file_name):
+        ''' File-like object with file_name contents (buffered by default),
+            None if not readable'''
+        contents = self.file_read(file_name)
+        # Storages report read errors returning a non bytes value
+        if not isinstance(contents, (bytes, bytearray, memoryview)):
+            return None
+        return io.BytesIO(contents)
+
+    def close(self):
+        ''' Complete any pending operation'''
+
+    def file_store_many(self, items):
+        ''' Store (file_name, contents) pairs, returns {file_name: ok}'''
+        results = {}
+        for file_name, contents in items:
+            try:
+                self.file_store(file_name, contents)
+                results[file_name] = True
+            except Exception as err:
+                logging.debug(err)
+                logging.error(f"Storing {file_name} failed")
+                results[file_name] = False
+        return results
+
+    def file_read_many(self, file_names):
+        ''' Generates (file_name, contents) pairs'''
+        for file_name in file_names:
+            yield file_name, self.file_read(file_name)
+
+    def file_exists_many(self, file_names):
+        ''' Check whether file_names exist, returns {file_name: exists}'''
+        return {file_name: self.file_exists(file_name) for file_name in file_names}
+
+    def delete_many(self, file_names):
+        ''' Delete file_names, returns the number of files deleted'''
+        return sum(1 for file_name in file_names if self.delete_file(file_name))
+
+    def file_list_since(self, since=None, id_range=None):
+        ''' Generates {name, size, hash, modified} for files in id_range
+            modified after since (all files if since is None).
+            Storages without file information report every file'''
+        for file_name in self.file_list(id_range=id_range):
+            yield {'name': file_name, 'size': None, 'hash': None, 'modified': None}
+
+    def file_deleted_since(self, since, id_range=None):
+        ''' Names of files deleted after since, None if deletions are not tracked'''
+        return None
+
+    def file_id_quantiles(self, num_parts, id_range=None):
+        ''' ntp ids splitting files in id_range into num_parts groups of
+            similar size (first id of each group but the first)'''
+        ntp_ids = sorted(get_ntpid(file_name) for file_name in self.file_list(id_range=id_range))
+        if not ntp_ids:
+            return []
+        return sorted(set(ntp_ids[len(ntp_ids) * part // num_parts] for part in range(1, num_parts)))
+
+    def can_copy_from(self, source):
+        ''' Check whether files can be copied from source server-side'''
+        return False
+
+    def file_list_info(self, id_range=None):
+        ''' Generates {name, size, hash, modified} for all files in id_range.
+            size or hash are None when not known from the listing'''
+        return self.file_list_since(None, id_range=id_range)
+
 class NtpStorageDisk (NtpStorage):
-    ''' Class to manage disk storage'''
-    def __init__(self, type_store='disk', data_dir=''):
+    ''' Class to manage disk storage.
+        Sharded folders (marked with SHARD_MARKER) keep each document at
+        data_dir/ntp00/12/ntp0012xxxx_field.ext'''
+    def __init__(self, type_store='disk', data_dir='', sharded=None, fsync='none', fsync_batch=100):
         super().__init__(type_store=type_store)
         self.data_dir = data_dir
+        if sharded is None:
+            sharded = os.path.exists(opj(data_dir, SHARD_MARKER))
+        self.sharded = sharded
+        self._shard_dirs = set()
+        # fsync policy: none | always (before rename) | batch (every fsync_batch files)
+        self.fsync = fsync
+        self.fsync_batch = fsync_batch
+        self._pending_sync = []
+        self._lock = threading.Lock()
+        # mkstemp creates files as 0600, stored files get the mode open() would give
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode = 0o666 & ~umask
+
+    def file_path(self, file_name):
+        ''' Path of file_name within data_dir'''
+        if self.sharded:
+            shard_dir = get_shard_dir(get_ntpid(file_name))
+            if shard_dir:
+                return opj(self.data_dir, shard_dir, file_name)
+        return opj(self.data_dir, file_name)
 
     def file_store(self, file_name, contents):
-        ''' Store contents as file_name '''
-        with open(opj(self.data_dir, file_name), 'bw') as output_file:
-            output_file.write(contents)
+        ''' Store contents (bytes or file-like) as file_name '''
+        file_path = self.file_path(file_name)
+        if self.sharded and os.path.dirname(file_path) not in self._shard_dirs:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            self._shard_dirs.add(os.path.dirname(file_path))
+        # Written to a hidden temporary file and renamed, partial files are never visible
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(tmp_fd, 'bw') as output_file:
+                os.fchmod(output_file.fileno(), self.file_mode)
+                if hasattr(contents, 'read'):
+                    shutil.copyfileobj(contents, output_file)
+                else:
+                    output_file.write(contents)
+                if self.fsync == 'always':
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if self.fsync == 'always':
+            fsync_dir(os.path.dirname(file_path))
+        elif self.fsync == 'batch':
+            with self._lock:
+                self._pending_sync.append(file_path)
+                sync_now = len(self._pending_sync) >= self.fsync_batch
+            if sync_now:
+                self.sync()
+
+    def sync(self):
+        ''' fsync files stored since last sync, and their folders'''
+        with self._lock:
+            pending, self._pending_sync = self._pending_sync, []
+        folders = set()
+        for file_path in pending:
+            try:
+                with open(file_path, 'rb') as stored_file:
+                    os.fsync(stored_file.fileno())
+                folders.add(os.path.dirname(file_path))
+            except OSError as err:
+                logging.debug(err)
+        for folder in folders:
+            fsync_dir(folder)
+
+    def close(self):
+        ''' Complete pending fsyncs'''
+        self.sync()
+
+    def file_open(self, file_name):
+        ''' Open file_name for reading, returns None if not readable'''
+        try:
+            return open(self.file_path(file_name), 'br')
+        except OSError as err:
+            logging.debug(err)
+            logging.error(f"Reading file {self.file_path(file_name)} failed")
+        return None
+
+    def file_view(self, file_name):
+        ''' Read-only memory-mapped view of file_name, no copy in Python memory'''
+        with open(self.file_path(file_name), 'br') as input_file:
+            if not os.fstat(input_file.fileno()).st_size:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ))
 
     def file_read(self, file_name):
         ''' Read file_name'''
         try:
-            with open(opj(self.data_dir, file_name), 'br') as input_file:
+            with open(self.file_path(file_name), 'br') as input_file:
                 return input_file.read()
         except Exception as err:
             logging.debug(err)
-            logging.error(f"Reading file {opj(self.data_dir, file_name)} failed")
+            logging.error(f"Reading file {self.file_path(file_name)} failed")
         return ''
 
     def delete_file(self, file_name):
         ''' Delete file_name from storage '''
         try:
-            os.remove({opj(self.data_dir, file_name)})
+            os.remove(self.file_path(file_name))
+            return True
         except Exception as err:
             logging.debug(err)
-            logging.error(f"Error deleting {opj(self.data_dir, file_name)}")
+            logging.error(f"Error deleting {self.file_path(file_name)}")
+        return False
+
+    def delete_many(self, file_names, max_workers=8):
+        ''' Delete file_names using a thread pool, returns the number of files deleted'''
+        return sum(
+            1 for file_name, deleted in bounded_map(self.delete_file, file_names, max_workers=max_workers)
+            if deleted
+        )
 
     def file_exists(self, file_name):
         ''' Check whether file_name exists'''
-        return os.path.exists(opj(self.data_dir, file_name))
+        return os.path.exists(self.file_path(file_name))
 
-    def file_list(self, id_range=None, set_Debug=False):
-        ''' Obtains list of file within id_range'''
-        file_list = []
-        for file in os.listdir(self.data_dir):
-            if id_range is None or is_in_range(get_ntpid(file), id_range):
-                file_list.append(file)
-        return file_list
+    def file_list(self, id_range=None, set_debug=False):
+        ''' Obtains list of file within id_range, only shard folders
+            overlapping id_range are scanned'''
+        return [entry.name for entry in self._scan(id_range)]
+
+    def file_list_since(self, since=None, id_range=None):
+        ''' Generates {name, size, hash, modified} for files in id_range
+            modified after since (UTC)'''
+        for entry in self._scan(id_range):
+            stat = entry.stat()
+            modified = datetime.utcfromtimestamp(stat.st_mtime)
+            if since is None or modified > since:
+                yield {'name': entry.name, 'size': stat.st_size, 'hash': None, 'modified': modified}
+
+    def _scan(self, id_range=None):
+        ''' Generates directory entries of files within id_range'''
+        folders = [self.data_dir]
+        while folders:
+            folder = folders.pop()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if self.sharded and prefix_in_range(
+                                os.path.relpath(entry.path, self.data_dir).replace(os.sep, ''),
+                                id_range
+                            ):
+                            folders.append(entry.path)
+                    elif entry.name.startswith('.'):
+                        # Shard marker and temporary files
+                        continue
+                    elif id_range is None or is_in_range(get_ntpid(entry.name), id_range):
+                        yield entry
+
+    def reshard(self, dry_run=False):
+        ''' Move files from a flat data_dir into shard folders, returns
+            the number of files moved'''
+        self.sharded = True
+        num_moved = 0
+        with os.scandir(self.data_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                new_path = self.file_path(entry.name)
+                if new_path == entry.path:
+                    logging.warning(f"{entry.name} is not a document name, kept at {self.data_dir}")
+                    continue
+                logging.debug(f"Moving {entry.path} to {new_path}")
+                if not dry_run:
+                    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                    os.rename(entry.path, new_path)
+                num_moved += 1
+        if not dry_run:
+            with open(opj(self.data_dir, SHARD_MARKER), 'w') as marker_file:
+                print(f"{SHARD_MARKER} ntp00/12/ntp0012xxxx_field.ext", file=marker_file)
+        return num_moved
 
 class NtpStorageGridFs (NtpStorage):
     '''Class to manage GridFS storage'''
-    def __init__(self, type_store='gridfs', gridfs_obj=None):
-        super().__init__(type_store=type_store)
-        self.gridfs = gridfs_obj
+    def __init__(self, type_store='gridfs', db=None, bucket_name='fs', compression=None):
+        super().__init__(type_store=type_store, compression=compression)
+        self.bucket_name = bucket_name
+        self.bucket = GridFSBucket(db, bucket_name=bucket_name)
+        self.files_col = db.get_collection(f"{bucket_name}.files")
+        self.chunks_col = db.get_collection(f"{bucket_name}.chunks")
+        # Tombstones of deleted files, used by incremental syncs
+        self.deleted_col = db.get_collection(f"{bucket_name}.deleted")
+        self._indexes_ready = False
 
     def file_store(self, file_name, contents):
-        ''' Stores file_name on gridfs'''
-        #removing previous version if exists
-        if contents:
-            self.delete_file(file_name)
-            self.gridfs.put(contents, filename=file_name)
+        ''' Stores file_name on gridfs (bytes or file-like contents)'''
+        if not contents:
+            return
+        # md5 of the original contents is kept as metadata, for sync comparisons
+        if hasattr(contents, 'read'):
+            contents = source = HashingReader(contents)
+        else:
+            source = None
+            md5 = hashlib.md5(contents).hexdigest()
+        metadata = {}
+        if self.compression:
+            contents, metadata = compress_contents(file_name, contents)
+        # New revision is only visible once all chunks are written,
+        # previous revisions are removed afterwards (replace-by-name)
+        grid_in = self.bucket.open_upload_stream(file_name)
+        try:
+            grid_in.write(contents)
+        except BaseException:
+            grid_in.abort()
+            raise
+        if source is not None:
+            md5 = source.md5.hexdigest()
+        grid_in.metadata = dict(metadata, md5=md5)
+        grid_in.close()
+        new_id = grid_in._id
+        self._delete_ids([
+            file['_id']
+            for file in self.files_col.find(
+                {'filename': file_name, '_id': {'$ne': new_id}},
+                projection={'_id': 1}
+            )
+        ])
+
+    def _open_stored(self, file_name):
+        ''' GridOut for file_name as stored, None if missing'''
+        try:
+            return self.bucket.open_download_stream_by_name(file_name)
+        except NoFile:
+            logging.error(f"File {file_name} not found")
+        return None
+
+    def file_open(self, file_name):
+        ''' Opens file_name for streaming reads, returns None if missing'''
+        grid_out = self._open_stored(file_name)
+        if grid_out is not None and grid_out.metadata and grid_out.metadata.get('codec'):
+            if grid_out.metadata['codec'] != 'zstd' or zstandard is None:
+                raise ValueError(f"Codec {grid_out.metadata['codec']} not available")
+            return zstandard.ZstdDecompressor().stream_reader(grid_out)
+        return grid_out
 
     def file_read(self, file_name):
         ''' Retreives file_name from gridFS'''
-        if self.file_exists(file_name):
-            file_id = self.gridfs.find_one({'filename':file_name})._id
-            try:
-                return self.gridfs.get(file_id).read()
-            except CorruptGridFile as err:
-                logging.error(f"Error reading {file_name} {err}")
-                return ''
-        else:
-            logging.error(f"File {file_name} not found")
+        grid_out = self._open_stored(file_name)
+        if grid_out is None:
+            return ''
+        try:
+            with grid_out:
+                return decompress_contents(
+                    grid_out.read(),
+                    (grid_out.metadata or {}).get('codec')
+                )
+        except CorruptGridFile as err:
+            logging.error(f"Error reading {file_name} {err}")
         return ''
 
     def delete_file(self, file_name):
-        ''' Delete file_name from gridFS'''
-        if self.file_exists(file_name):
-            file_id = self.gridfs.find_one({'filename':file_name})._id
-            self.gridfs.delete(file_id)
+        ''' Delete file_name from gridFS (all revisions), leaving a tombstone'''
+        file_ids = [
+            file['_id']
+            for file in self.files_col.find({'filename': file_name}, projection={'_id': 1})
+        ]
+        if not file_ids:
+            return False
+        self._delete_ids(file_ids)
+        self.deleted_col.update_one(
+            {'_id': file_name},
+            {'$set': {'deleted': datetime.utcnow()}},
+            upsert=True
+        )
+        return True
+
+    def delete_many(self, file_names, batch_size=cts.DELETE_BATCH):
+        ''' Delete file_names (all revisions) in batches, leaving tombstones.
+            Returns the number of files deleted'''
+        file_names = list(file_names)
+        num_deleted = 0
+        for pos in range(0, len(file_names), batch_size):
+            file_ids = []
+            deleted = set()
+            for file in self.files_col.find(
+                    {'filename': {'$in': file_names[pos:pos + batch_size]}},
+                    projection={'_id': 1, 'filename': 1}
+                ):
+                file_ids.append(file['_id'])
+                deleted.add(file['filename'])
+            if not file_ids:
+                continue
+            self._delete_ids(file_ids)
+            now = datetime.utcnow()
+            self.deleted_col.bulk_write(
+                [UpdateOne({'_id': file_name}, {'$set': {'deleted': now}}, upsert=True) for file_name in deleted],
+                ordered=False
+            )
+            num_deleted += len(deleted)
+        return num_deleted
+
+    def _delete_ids(self, file_ids):
+        ''' Delete files and chunks for a list of file _ids'''
+        if not file_ids:
+            return
+        self.files_col.delete_many({'_id': {'$in': file_ids}})
+        self.chunks_col.delete_many({'files_id': {'$in': file_ids}})
 
     def file_exists(self, file_name, no_ext=False):
         ''' Check whether file_name exists on gridFS'''
         if no_ext:
-            rgx = re.compile(f"^{file_name}")
-            return self.gridfs.exists({'filename':rgx})
+            query = {'filename': re.compile(f"^{file_name}")}
         else:
-            return self.gridfs.exists(filename=file_name)
+            query = {'filename': file_name}
+        return self.files_col.find_one(query, projection={'_id': 1}) is not None
+
+    def _range_query(self, id_range, field='filename'):
+        ''' Query selecting files in id_range by name (field)'''
+        condition = get_filename_range(id_range)
+        if condition is None:
+            return {}
+        return {field: condition}
 
     def file_list(self, id_range=None, set_debug=False):
         ''' Obtains list of files in id_range'''
         files = []
-        for file in self.gridfs.find():
-            if id_range is None or is_in_range(get_ntpid(file.name), id_range):
-                files.append(file.name)
+        for file in self.files_col.find(self._range_query(id_range), projection={'_id': 0, 'filename': 1}):
+            if id_range is None or is_in_range(get_ntpid(file['filename']), id_range):
+                files.append(file['filename'])
         return files
 
+    def file_list_since(self, since=None, id_range=None):
+        ''' Generates {name, size, hash, modified} for files in id_range
+            uploaded after since. size is the original size of compressed files'''
+        query = self._range_query(id_range)
+        if since is not None:
+            query['uploadDate'] = {'$gt': since}
+        for file in self.files_col.find(
+                query,
+                projection={'_id': 0, 'filename': 1, 'length': 1, 'md5': 1, 'metadata': 1, 'uploadDate': 1}
+            ):
+            if id_range is None or is_in_range(get_ntpid(file['filename']), id_range):
+                metadata = file.get('metadata') or {}
+                yield {
+                    'name': file['filename'],
+                    'size': metadata.get('size', file['length']),
+                    # md5 stored on upload, or legacy GridFS md5 (never compressed)
+                    'hash': metadata.get('md5', file.get('md5')),
+                    'modified': file['uploadDate']
+                }
+
+    def file_deleted_since(self, since, id_range=None):
+        ''' Names of files deleted after since, from tombstones'''
+        query = self._range_query(id_range, field='_id')
+        if since is not None:
+            query['deleted'] = {'$gt': since}
+        return [
+            tombstone['_id']
+            for tombstone in self.deleted_col.find(query, projection={'_id': 1})
+            if id_range is None or is_in_range(get_ntpid(tombstone['_id']), id_range)
+        ]
+
+    def file_id_quantiles(self, num_parts, id_range=None):
+        ''' ntp ids splitting files in id_range into num_parts groups of
+            similar size, from a $bucketAuto aggregation on file names'''
+        pipeline = []
+        if id_range is not None:
+            pipeline.append({'$match': self._range_query(id_range)})
+        pipeline.append({'$bucketAuto': {'groupBy': '$filename', 'buckets': num_parts}})
+        return sorted(set(
+            get_ntpid(bucket['_id']['min'])
+            for bucket in list(self.files_col.aggregate(pipeline, allowDiskUse=True))[1:]
+        ))
+
+    def can_copy_from(self, source):
+        ''' Check whether source is another GridFS bucket in the same database'''
+        return isinstance(source, NtpStorageGridFs) and\
+            source.bucket_name != self.bucket_name and\
+            source.files_col.database == self.files_col.database
+
+    def copy_file(self, source, file_name):
+        ''' Server-side copy of file_name from source bucket'''
+        file = source.files_col.find_one(
+            {'filename': file_name},
+            projection={'_id': 1},
+            sort=[('uploadDate', -1)]
+        )
+        if file is None:
+            raise NoFile(f"{file_name} not found at {source.bucket_name}")
+        self.copy_ids_from(source, [file['_id']])
+
+    def copy_ids_from(self, source, file_ids):
+        ''' Server-side copy of files (by _id, kept) from source bucket using
+            $merge, no document contents go through the client. Chunks are
+            merged before files, so copies are not visible before their
+            chunks. uploadDate is set to the copy time, and previous
+            revisions with the same names are removed'''
+        if not file_ids:
+            return
+        self._ensure_indexes()
+        source.chunks_col.aggregate([
+            {'$match': {'files_id': {'$in': file_ids}}},
+            {'$merge': {'into': self.chunks_col.name, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ], allowDiskUse=True)
+        source.files_col.aggregate([
+            {'$match': {'_id': {'$in': file_ids}}},
+            {'$set': {'uploadDate': '$$NOW'}},
+            {'$merge': {'into': self.files_col.name, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ], allowDiskUse=True)
+        file_names = source.files_col.distinct('filename', {'_id': {'$in': file_ids}})
+        self._delete_ids([
+            file['_id']
+            for file in self.files_col.find(
+                {'filename': {'$in': file_names}, '_id': {'$nin': file_ids}},
+                projection={'_id': 1}
+            )
+        ])
+
+    def _ensure_indexes(self):
+        ''' GridFS indexes, created by GridFSBucket only on its first upload'''
+        if self._indexes_ready:
+            return
+        ntp_indexes.ensure_indexes(self.files_col, 'gridfs_files')
+        ntp_indexes.ensure_indexes(self.chunks_col, 'gridfs_chunks')
+        self._indexes_ready = True
+
+    def files_for_ids(self, ntp_ids, id_range=None):
+        ''' Generates {_id, filename} of files belonging to ntp_ids (sorted),
+            merge-joining them with the files sorted by name'''
+        files = self.files_col.find(
+            self._range_query(id_range),
+            projection={'_id': 1, 'filename': 1},
+            sort=[('filename', 1)]
+        )
+        file = next(files, None)
+        for ntp_id in ntp_ids:
+            while file is not None and get_ntpid(file['filename']) < ntp_id:
+                file = next(files, None)
+            while file is not None and get_ntpid(file['filename']) == ntp_id:
+                yield file
+                file = next(files, None)
+
     def file_list_per_doc(self, files_col, ntp_id):
         ''' Obtains stored files corresponding to ntp_id'''
         filename_pattern = re.compile (f"^{ntp_id}")
@@ -137,29 +754,235 @@ class NtpStorageGridFs (NtpStorage):
             file_list.append(file)
         return file_list
 
+class SwiftConnectionPool:
+    ''' Pool of swift connections sharing credentials and auth token.
+        swiftclient connections are not thread-safe, each thread borrows one'''
+    def __init__(self, connection, size=8):
+        self.template = connection
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        ''' Borrow a connection for the duration of the with block'''
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return clone_swift_connection(self.template)
+        return self._idle.get()
+
 class NtpStorageSwift (NtpStorage):
     '''Class to manage Swift storage'''
     def __init__(self, type_store='swift', **kwargs):
-        super().__init__(type_store=type_store)
-        self.connection = kwargs['swift_connection']
+        super().__init__(type_store=type_store, compression=kwargs.get('compression'))
         self.container = kwargs['swift_container']
         self.data_prefix = kwargs['swift_prefix']
+        self.max_workers = kwargs.get('max_workers', 8)
+        self.listing_limit = kwargs.get('listing_limit', 10000)
+        self.listing_shards = kwargs.get('listing_shards', 100)
+        self.segment_threshold = kwargs.get('segment_threshold') or cts.SWIFT_SEGMENT_THRESHOLD
+        self.segment_size = kwargs.get('segment_size') or cts.SWIFT_SEGMENT_SIZE
+        self.segment_container = kwargs.get('segment_container') or f"{self.container}_segments"
+        self._segment_container_ready = False
+        if kwargs.get('swift_pool') is not None:
+            self.pool = kwargs['swift_pool']
+        else:
+            self.pool = SwiftConnectionPool(kwargs['swift_connection'], size=self.max_workers)
+        self.connection = self.pool.template
 
     def file_store(self, file_name, contents):
-        """ Store contents in file_name at swift"""
-        self.connection.put_object(
-            self.container,
-            opj(self.data_prefix, file_name),
-            contents=contents
-        )
+        """ Store contents (bytes or file-like) in file_name at swift.
+            Contents larger than segment_threshold are uploaded as a
+            Static Large Object, with segments sent in parallel. File-like
+            contents of known size are streamed, only streams of unknown
+            size are buffered up to segment_threshold"""
+        object_name = opj(self.data_prefix, file_name)
+        headers = {}
+        if self.compression:
+            contents, metadata = compress_contents(file_name, contents)
+            for key, value in metadata.items():
+                headers[f"{SWIFT_META_PREFIX}{key}"] = str(value)
+            if metadata:
+                headers['Content-Type'] = ZSTD_CONTENT_TYPE
+        if hasattr(contents, 'read'):
+            size = get_stream_size(contents)
+            if size is not None and size <= self.segment_threshold:
+                self._store_single(object_name, contents, headers=headers, content_length=size)
+                return
+            segments = iter_segments(contents, self.segment_size)
+            if size is not None:
+                self._store_segmented(object_name, segments, headers=headers)
+                return
+        elif len(contents) <= self.segment_threshold:
+            self._store_single(object_name, contents, headers=headers)
+            return
+        else:
+            segments = (
+                contents[pos:pos + self.segment_size]
+                for pos in range(0, len(contents), self.segment_size)
+            )
+        # Size not known, buffer up to segment_threshold to decide between single and segmented upload
+        head = []
+        head_size = 0
+        for segment in segments:
+            head.append(segment)
+            head_size += len(segment)
+            if head_size > self.segment_threshold:
+                break
+        if head_size <= self.segment_threshold:
+            self._store_single(object_name, b''.join(head), headers=headers)
+            return
+        self._store_segmented(object_name, itertools.chain(head, segments), headers=headers)
+
+    def _store_single(self, object_name, contents, headers=None, content_length=None):
+        ''' Upload object_name with a single PUT, file-like contents are
+            streamed (content_length bytes). Segments of a previous SLO
+            upload of the same object are deleted afterwards'''
+        with self.pool.connection() as conn:
+            try:
+                old_headers = conn.head_object(self.container, object_name)
+            except sw.ClientException as err:
+                if err.http_status != 404:
+                    raise
+                old_headers = {}
+            conn.put_object(
+                self.container,
+                object_name,
+                contents=contents,
+                content_length=content_length,
+                headers=headers
+            )
+        if old_headers.get('x-static-large-object', '').lower() == 'true':
+            self._delete_old_segments(object_name)
+
+    def _store_segmented(self, object_name, segments, headers=None):
+        ''' Upload segments in parallel and write the SLO manifest for object_name'''
+        if not self._segment_container_ready:
+            with self.pool.connection() as conn:
+                conn.put_container(self.segment_container)
+            self._segment_container_ready = True
+        segment_prefix = f"{object_name}/slo/{time.time():.6f}"
+
+        def _upload(item):
+            index, data = item
+            with self.pool.connection() as conn:
+                etag = conn.put_object(
+                    self.segment_container,
+                    f"{segment_prefix}/{index:08d}",
+                    contents=data
+                )
+            return etag, len(data)
+
+        manifest = []
+        # max_pending bounds the segments held in memory
+        for (index, data), (etag, size) in bounded_map(
+                _upload,
+                enumerate(segments),
+                max_workers=self.max_workers,
+                max_pending=self.max_workers
+            ):
+            manifest.append((index, {
+                'path': f"/{self.segment_container}/{segment_prefix}/{index:08d}",
+                'etag': etag,
+                'size_bytes': size
+            }))
+        manifest = [segment for index, segment in sorted(manifest, key=lambda item: item[0])]
+        logging.debug(f"Storing {object_name} as {len(manifest)} segments")
+        with self.pool.connection() as conn:
+            conn.put_object(
+                self.container,
+                object_name,
+                contents=json.dumps(manifest),
+                headers=headers,
+                query_string='multipart-manifest=put'
+            )
+        self._delete_old_segments(object_name, keep_prefix=segment_prefix)
+
+    def _delete_old_segments(self, object_name, keep_prefix=None):
+        ''' Delete segments from previous SLO uploads of object_name, except
+            those under keep_prefix (the current upload)'''
+        with self.pool.connection() as conn:
+            try:
+                head, old_segments = conn.get_container(
+                    self.segment_container,
+                    prefix=f"{object_name}/slo/",
+                    full_listing=True
+                )
+            except sw.ClientException as err:
+                if err.http_status != 404:
+                    raise
+                return
+            for segment in old_segments:
+                if keep_prefix is None or not segment['name'].startswith(keep_prefix):
+                    conn.delete_object(self.segment_container, segment['name'])
+
+    def can_copy_from(self, source):
+        ''' Check whether source is a swift storage on the same account,
+            so that objects can be copied server-side'''
+        if not isinstance(source, NtpStorageSwift):
+            return False
+        if source.pool is self.pool:
+            return True
+        mine = self.pool.template
+        theirs = source.pool.template
+        return (mine.authurl, mine.user, mine.os_options) == (theirs.authurl, theirs.user, theirs.os_options)
+
+    def copy_file(self, source, file_name):
+        ''' Server-side copy (X-Copy-From) of file_name from source, no
+            data goes through the client. Objects over the cluster max.
+            object size (SLOs) are streamed through the client instead'''
+        source_object = opj(source.data_prefix, file_name)
+        try:
+            with self.pool.connection() as conn:
+                conn.put_object(
+                    self.container,
+                    opj(self.data_prefix, file_name),
+                    contents=b'',
+                    headers={'X-Copy-From': quote(f"/{source.container}/{source_object}")}
+                )
+        except sw.ClientException as err:
+            if err.http_status != 413:
+                raise
+            logging.debug(f"{source_object} too large for server-side copy")
+            self.file_store(file_name, source.file_open(file_name))
+
+    def file_store_many(self, items):
+        ''' Store (file_name, contents) pairs concurrently, returns {file_name: ok}'''
+        def _store(item):
+            file_name, contents = item
+            try:
+                self.file_store(file_name, contents)
+                return True
+            except Exception as err:
+                logging.debug(err)
+                logging.error(f"upload of {file_name} failed")
+            return False
+        return {
+            item[0]: stored
+            for item, stored in bounded_map(_store, items, max_workers=self.max_workers)
+        }
 
     def file_exists(self, file_name):
         ''' Check whether file_name exists'''
         try:
-            resp_headers = self.connection.head_object(
-                self.container,
-                opj(self.data_prefix, file_name)
-            )
+            with self.pool.connection() as conn:
+                conn.head_object(
+                    self.container,
+                    opj(self.data_prefix, file_name)
+                )
             return True
         except sw.ClientException as e:
             logging.debug(e)
@@ -168,21 +991,24 @@ class NtpStorageSwift (NtpStorage):
             logging.error("Error connecting swift storage")
             sys.exit()
 
+    def file_exists_many(self, file_names):
+        ''' Check concurrently whether file_names exist, returns {file_name: exists}'''
+        return dict(bounded_map(self.file_exists, file_names, max_workers=self.max_workers))
+
     def get_folder(self, tmp_dir='/tmp', remote_prefix=None):
         ''' get swift folder contents'''
-        head, files = self.connection.get_container(
-            self.container,
-            prefix=remote_prefix,
-            full_listing=True
-            )
-        ok = 0
-        ko = 0
+        files = self._list_prefix(remote_prefix)
         logging.debug(f"{len(files)} found from {remote_prefix}")
         if not os.path.isdir(tmp_dir):
             logging.debug(f"Creating {tmp_dir}")
             os.mkdir(tmp_dir)
-        for file in files:
-            status = self.file_read(file['name'], tmp_dir)
+        ok = 0
+        ko = 0
+        for file, status in bounded_map(
+                lambda file: self._download_object(file['name'], tmp_dir),
+                files,
+                max_workers=self.max_workers
+            ):
             if status:
                 ok += 1
             else:
@@ -193,16 +1019,21 @@ class NtpStorageSwift (NtpStorage):
     def file_read(self, file_name):
         ''' Retrieve file_name from swift'''
         try:
-            headers, data = self.connection.get_object(
-                self.container,
-                opj(self.data_prefix, file_name)
-            )
-            return data
+            with self.pool.connection() as conn:
+                headers, data = conn.get_object(
+                    self.container,
+                    opj(self.data_prefix, file_name)
+                )
+            return decompress_contents(data, headers.get(f"{SWIFT_META_PREFIX}codec".lower()))
         except Exception as e:
             logging.debug(e)
             logging.error(f"download of {file_name} failed")
         return 0
 
+    def file_read_many(self, file_names):
+        ''' Retrieve file_names concurrently, generates (file_name, contents) pairs'''
+        return bounded_map(self.file_read, file_names, max_workers=self.max_workers)
+
     def download_file(self, file_name, tmp_dir='/tmp'):
         ''' Download file_name to a disk file'''
         ok = False
@@ -216,32 +1047,514 @@ class NtpStorageSwift (NtpStorage):
             logging.error(f"download of {file_name} failed")
         return ok
 
+    def _download_object(self, object_name, tmp_dir):
+        ''' Download object (full name, data_prefix not added) to tmp_dir'''
+        try:
+            with self.pool.connection() as conn:
+                headers, data = conn.get_object(self.container, object_name)
+            data = decompress_contents(data, headers.get(f"{SWIFT_META_PREFIX}codec".lower()))
+            with open(opj(tmp_dir, os.path.basename(object_name)), "bw") as output_file:
+                output_file.write(data)
+            return True
+        except Exception as e:
+            logging.debug(e)
+            logging.error(f"download of {object_name} failed")
+        return False
+
     def delete_file(self, file_name):
-        ''' Delete file_name from swift'''
+        ''' Delete file_name from swift (including SLO segments)'''
         try:
-            self.connection.delete_object(
-                self.container,
-                opj(self.data_prefix, file_name)
-            )
+            with self.pool.connection() as conn:
+                headers = conn.head_object(self.container, opj(self.data_prefix, file_name))
+                if headers.get('x-static-large-object', '').lower() == 'true':
+                    query_string = 'multipart-manifest=delete'
+                else:
+                    query_string = None
+                conn.delete_object(
+                    self.container,
+                    opj(self.data_prefix, file_name),
+                    query_string=query_string
+                )
+            return True
         except Exception as err:
             logging.debug(err)
             logging.error(f"deletion of {file_name} failed")
-        return 0
+        return False
 
-    def file_list(self, id_range=None, set_debug=False):
-        ''' Obtains list of files in id_range'''
-        logging.getLogger().setLevel(20)
-        head, files = self.connection.get_container(
-            self.container,
-            full_listing=True
+    def delete_many(self, file_names):
+        ''' Delete file_names with bulk-delete requests (or concurrent
+            deletes if the cluster does not support them), including
+            SLO segments. Returns the number of files deleted'''
+        file_names = list(file_names)
+        batch_size = self._bulk_delete_size()
+        if not batch_size:
+            return sum(
+                1 for file_name, deleted in bounded_map(self.delete_file, file_names, max_workers=self.max_workers)
+                if deleted
+            )
+        object_names = [opj(self.data_prefix, file_name) for file_name in file_names]
+        num_deleted = self._bulk_delete(self.container, object_names, batch_size)
+        segments = self._slo_segments(set(object_names))
+        if segments:
+            logging.debug(f"Deleting {len(segments)} SLO segments")
+            self._bulk_delete(self.segment_container, segments, batch_size)
+        return num_deleted
+
+    def _bulk_delete_size(self):
+        ''' Max. objects per bulk-delete request, 0 if bulk-delete is not available'''
+        try:
+            with self.pool.connection() as conn:
+                capabilities = conn.get_capabilities()
+        except Exception as err:
+            logging.debug(err)
+            return 0
+        if 'bulk_delete' not in capabilities:
+            return 0
+        return min(
+            capabilities['bulk_delete'].get('max_deletes_per_request', cts.SWIFT_BULK_DELETE_MAX),
+            cts.SWIFT_BULK_DELETE_MAX
         )
-        if set_debug:
-            logging.getLogger().setLevel(10)
-        list = []
-        for file in files:
-            if not file['name'].startswith(self.data_prefix):
+
+    def _bulk_delete(self, container, object_names, batch_size):
+        ''' Delete objects from container in bulk-delete batches, returns number deleted'''
+        num_deleted = 0
+        for pos in range(0, len(object_names), batch_size):
+            body = '\n'.join(
+                quote(f"/{container}/{object_name}")
+                for object_name in object_names[pos:pos + batch_size]
+            ).encode()
+            try:
+                with self.pool.connection() as conn:
+                    headers, result = conn.post_account(
+                        headers={'Content-Type': 'text/plain', 'Accept': 'application/json'},
+                        query_string='bulk-delete',
+                        data=body
+                    )
+            except sw.ClientException as err:
+                logging.debug(err)
+                logging.error(f"Bulk deletion at {container} failed")
+                continue
+            result = json.loads(result)
+            num_deleted += result.get('Number Deleted', 0)
+            for path, status in result.get('Errors', []):
+                logging.error(f"deletion of {path} failed ({status})")
+        return num_deleted
+
+    def _slo_segments(self, object_names):
+        ''' Names of SLO segments belonging to object_names'''
+        try:
+            with self.pool.connection() as conn:
+                head, segments = conn.get_container(
+                    self.segment_container,
+                    prefix=self.data_prefix,
+                    full_listing=True
+                )
+        except sw.ClientException as err:
+            if err.http_status != 404:
+                logging.error(f"Listing of {self.segment_container} failed")
+            return []
+        # Segments are named object_name/slo/timestamp/index
+        return [
+            segment['name'] for segment in segments
+            if segment['name'].split('/slo/', 1)[0] in object_names
+        ]
+
+    def file_list(self, id_range=None, set_debug=False):
+        ''' Generates names of files in id_range, listing prefix shards in parallel'''
+        for file_name, file in self._list_objects(id_range):
+            yield file_name
+
+    def file_list_since(self, since=None, id_range=None):
+        ''' Generates {name, size, hash, modified} for files in id_range
+            modified after since. hash is the object ETag, not available
+            for compressed objects and SLOs, whose ETag is not the md5
+            of the document'''
+        for file_name, file in self._list_objects(id_range):
+            modified = datetime.strptime(file['last_modified'], '%Y-%m-%dT%H:%M:%S.%f')
+            if since is not None and modified <= since:
+                continue
+            size, file_hash = file['bytes'], file['hash']
+            if file.get('content_type') == ZSTD_CONTENT_TYPE:
+                size, file_hash = None, None
+            elif 'slo_etag' in file or size > self.segment_threshold:
+                file_hash = None
+            yield {'name': file_name, 'size': size, 'hash': file_hash, 'modified': modified}
+
+    def _list_objects(self, id_range=None):
+        ''' Generates (file_name, listing entry) for objects in id_range'''
+        prefixes = [
+            opj(self.data_prefix, prefix)
+            for prefix in get_id_prefixes(id_range, max_prefixes=self.listing_shards)
+        ]
+        for prefix, files in bounded_map(self._list_prefix, prefixes, max_workers=self.max_workers):
+            for file in files:
+                file_name = os.path.basename(file['name'])
+                if '_' in file_name and is_in_range(get_ntpid(file_name), id_range):
+                    yield file_name, file
+
+    def _list_prefix(self, prefix):
+        ''' Full listing of objects under prefix, using marker pagination'''
+        files = []
+        marker = None
+        with self.pool.connection() as conn:
+            while True:
+                head, page = conn.get_container(
+                    self.container,
+                    prefix=prefix,
+                    marker=marker,
+                    limit=self.listing_limit
+                )
+                if not page:
+                    break
+                files.extend(page)
+                marker = page[-1]['name']
+        logging.debug(f"{len(files)} objects found at {self.container}:{prefix}")
+        return files
+
+class NtpStorageCached (NtpStorage):
+    ''' Read-through local disk cache in front of another storage.
+        Cached copies are evicted in LRU order above max_size bytes and
+        validated against their sha256 on every hit'''
+    def __init__(self, storage, cache_dir, max_size=cts.CACHE_MAX_SIZE):
+        super().__init__(type_store=storage.type)
+        self.storage = storage
+        self.cache = NtpStorageDisk(data_dir=cache_dir, sharded=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalid = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def __getattr__(self, name):
+        # Anything not cache-related is served by the wrapped storage
+        if name == 'storage':
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def _load_index(self):
+        ''' Rebuild LRU index from cache contents (older access first)'''
+        entries = []
+        for file_name in self.cache.file_list():
+            if file_name.endswith(CACHE_HASH_SUFFIX):
                 continue
-            if '_' in file['name'] and (id_range is None or\
-                    is_in_range(get_ntpid(os.path.basename(file['name'])), id_range)):
-                list.append(os.path.basename(file['name']))
-        return list
+            try:
+                stat = os.stat(self.cache.file_path(file_name))
+                with open(self.cache.file_path(file_name + CACHE_HASH_SUFFIX), 'r') as hash_file:
+                    entries.append((stat.st_atime, file_name, stat.st_size, hash_file.read().strip()))
+            except OSError:
+                # Incomplete entry
+                self.cache.delete_file(file_name)
+        for atime, file_name, size, sha256 in sorted(entries):
+            self._entries[file_name] = (size, sha256)
+            self._size += size
+        logging.debug(f"Cache at {self.cache.data_dir}: {len(self._entries)} files, {self._size} bytes")
+        self._evict_to(self.max_size)
+
+    def _add(self, file_name, contents):
+        ''' Store a copy of contents in cache'''
+        if len(contents) > self.max_size:
+            return
+        sha256 = hashlib.sha256(contents).hexdigest()
+        self.cache.file_store(file_name + CACHE_HASH_SUFFIX, sha256.encode())
+        self.cache.file_store(file_name, contents)
+        with self._lock:
+            if file_name in self._entries:
+                self._size -= self._entries.pop(file_name)[0]
+            self._entries[file_name] = (len(contents), sha256)
+            self._size += len(contents)
+        self._evict_to(self.max_size)
+
+    def _remove(self, file_name):
+        ''' Drop file_name from cache'''
+        with self._lock:
+            if file_name not in self._entries:
+                return
+            self._size -= self._entries.pop(file_name)[0]
+        for cache_file in (file_name, file_name + CACHE_HASH_SUFFIX):
+            try:
+                os.remove(self.cache.file_path(cache_file))
+            except OSError as err:
+                logging.debug(err)
+
+    def _evict_to(self, max_size):
+        ''' Evict least recently used entries until cache size <= max_size'''
+        while True:
+            with self._lock:
+                if self._size <= max_size or not self._entries:
+                    return
+                file_name = next(iter(self._entries))
+            self._remove(file_name)
+            self.evictions += 1
+
+    def _cached_read(self, file_name):
+        ''' Contents from cache, None if missing or not valid'''
+        with self._lock:
+            if file_name not in self._entries:
+                return None
+            self._entries.move_to_end(file_name)
+            size, sha256 = self._entries[file_name]
+        try:
+            with open(self.cache.file_path(file_name), 'rb') as cache_file:
+                contents = cache_file.read()
+        except OSError as err:
+            logging.debug(err)
+            contents = None
+        if contents is None or hashlib.sha256(contents).hexdigest() != sha256:
+            logging.warning(f"Cached copy of {file_name} not valid, discarding")
+            self.invalid += 1
+            self._remove(file_name)
+            return None
+        return contents
+
+    def file_read(self, file_name):
+        ''' Retrieve file_name, from cache if available'''
+        contents = self._cached_read(file_name)
+        if contents is not None:
+            self.hits += 1
+            return contents
+        self.misses += 1
+        contents = self.storage.file_read(file_name)
+        if contents:
+            self._add(file_name, contents)
+        return contents
+
+    def file_read_many(self, file_names):
+        ''' Generates (file_name, contents) pairs, missing files are
+            retrieved with the wrapped storage batch method'''
+        missing = []
+        for file_name in file_names:
+            contents = self._cached_read(file_name)
+            if contents is None:
+                missing.append(file_name)
+            else:
+                self.hits += 1
+                yield file_name, contents
+        self.misses += len(missing)
+        for file_name, contents in self.storage.file_read_many(missing):
+            if contents:
+                self._add(file_name, contents)
+            yield file_name, contents
+
+    def file_open(self, file_name):
+        ''' File-like object with file_name contents. Misses are streamed
+            from the wrapped storage, and not cached'''
+        contents = self._cached_read(file_name)
+        if contents is not None:
+            self.hits += 1
+            return io.BytesIO(contents)
+        self.misses += 1
+        return self.storage.file_open(file_name)
+
+    def file_exists_many(self, file_names):
+        ''' Check whether file_names exist at wrapped storage'''
+        return self.storage.file_exists_many(file_names)
+
+    def file_list_since(self, since=None, id_range=None):
+        ''' Listing of wrapped storage'''
+        return self.storage.file_list_since(since, id_range=id_range)
+
+    def file_deleted_since(self, since, id_range=None):
+        ''' Deletions tracked by wrapped storage'''
+        return self.storage.file_deleted_since(since, id_range=id_range)
+
+    def file_list_info(self, id_range=None):
+        ''' Listing of wrapped storage'''
+        return self.storage.file_list_info(id_range=id_range)
+
+    def file_id_quantiles(self, num_parts, id_range=None):
+        ''' Quantiles of wrapped storage'''
+        return self.storage.file_id_quantiles(num_parts, id_range=id_range)
+
+    def can_copy_from(self, source):
+        ''' Check whether wrapped storage can copy from source server-side'''
+        return self.storage.can_copy_from(get_uncached(source))
+
+    def copy_file(self, source, file_name):
+        ''' Server-side copy to wrapped storage, cached copy is discarded'''
+        self._remove(file_name)
+        self.storage.copy_file(get_uncached(source), file_name)
+
+    def copy_ids_from(self, source, file_ids):
+        ''' Server-side copy by _id to wrapped storage, cached copies are discarded'''
+        source = get_uncached(source)
+        self.storage.copy_ids_from(source, file_ids)
+        for file_name in source.files_col.distinct('filename', {'_id': {'$in': file_ids}}):
+            self._remove(file_name)
+
+    def file_store(self, file_name, contents):
+        ''' Store on wrapped storage, cached copy is discarded'''
+        self._remove(file_name)
+        self.storage.file_store(file_name, contents)
+
+    def file_store_many(self, items):
+        ''' Store (file_name, contents) pairs on wrapped storage'''
+        def _uncached(items):
+            for file_name, contents in items:
+                self._remove(file_name)
+                yield file_name, contents
+        return self.storage.file_store_many(_uncached(items))
+
+    def delete_file(self, file_name):
+        ''' Delete file_name from wrapped storage and cache'''
+        self._remove(file_name)
+        return self.storage.delete_file(file_name)
+
+    def delete_many(self, file_names):
+        ''' Delete file_names from wrapped storage and cache'''
+        file_names = list(file_names)
+        for file_name in file_names:
+            self._remove(file_name)
+        return self.storage.delete_many(file_names)
+
+    def close(self):
+        ''' Close wrapped storage'''
+        logging.info(self.stats())
+        self.storage.close()
+
+    def stats(self):
+        ''' Cache usage summary'''
+        return (
+            f"Cache {self.cache.data_dir}: {self.hits} hits, {self.misses} misses, "
+            f"{self.evictions} evictions, {self.invalid} invalid, "
+            f"{len(self._entries)} files, {self._size / 1024 / 1024:.1f} MB"
+        )
+
+def get_uncached(storage):
+    ''' Storage wrapped by NtpStorageCached, storage itself otherwise'''
+    if isinstance(storage, NtpStorageCached):
+        return storage.storage
+    return storage
+
+def get_cached_storage(storage, config):
+    ''' Wrap storage with a local cache when CACHE_DIR is set in config'''
+    if not config.get('CACHE_DIR'):
+        return storage
+    logging.info(f"Using local cache at {config['CACHE_DIR']}")
+    return NtpStorageCached(
+        storage,
+        config['CACHE_DIR'],
+        max_size=config.get('CACHE_MAX_SIZE_MB', cts.CACHE_MAX_SIZE // 1024 // 1024) * 1024 * 1024
+    )
+
+# Storage registry. Builders receive (factory, container, path, options) and
+# return a configured NtpStorage. New backends only need to be registered here.
+STORAGE_BUILDERS = {}
+
+def register_storage(scheme):
+    ''' Decorator registering a storage builder for URIs using scheme'''
+    def _register(builder):
+        STORAGE_BUILDERS[scheme] = builder
+        return builder
+    return _register
+
+def parse_storage_uri(uri):
+    ''' Parse a storage URI into (scheme, container, path, options)
+        Accepted forms: folder | disk:folder | gridfs:[bucket] | [container]@swift:[folder]
+        optionally followed by ?option=value&option=value'''
+    options = {}
+    if '?' in uri:
+        uri, query = uri.split('?', 1)
+        options = dict(parse_qsl(query))
+    if ':' not in uri:
+        return 'disk', None, uri or None, options
+    location, path = uri.split(':', 1)
+    container = None
+    if '@' in location:
+        container, scheme = location.split('@', 1)
+    else:
+        scheme = location
+    return scheme, container or None, path or None, options
+
+def swift_connection_from_config(config):
+    ''' Swift connection using application credentials from config'''
+    return sw.Connection(
+        authurl=config['OS_AUTH_URL'],
+        auth_version=3,
+        os_options={
+            'auth_type': config['OS_AUTH_TYPE'],
+            'region_name': config['OS_REGION_NAME'],
+            'application_credential_id': config['OS_APPLICATION_CREDENTIAL_ID'],
+            'application_credential_secret': config['OS_APPLICATION_CREDENTIAL_SECRET'],
+            'service_project_name': config['OS_PROJECT_NAME']
+        }
+    )
+
+class StorageFactory:
+    ''' Builds storages from URIs. MongoDB and Swift connections (and the
+        Swift connection pool) are shared among all storages built'''
+    def __init__(self, config, db_lnk=None):
+        self.config = config
+        self.db_lnk = db_lnk
+        self.swift_pools = {}
+
+    def get_storage(self, uri):
+        ''' Configured storage for uri'''
+        scheme, container, path, options = parse_storage_uri(uri)
+        if scheme not in STORAGE_BUILDERS:
+            raise ValueError(f"Unknown storage type {scheme} in {uri}")
+        storage = STORAGE_BUILDERS[scheme](self, container, path, options)
+        if options.get('cache', '0') not in ('0', 'false', 'no'):
+            storage = get_cached_storage(storage, self.config)
+        return storage
+
+    def get_db(self):
+        ''' MongoDB database, connected on first use'''
+        if self.db_lnk is None:
+            self.db_lnk = Mongo_db(
+                self.config['MONGODB_HOST'],
+                self.config['MONGODB_DB'],
+                False,
+                self.config['MONGODB_AUTH'],
+                credentials=self.config['MONGODB_CREDENTIALS'],
+                connect_db=True
+            )
+        return self.db_lnk.db
+
+    def get_swift_pool(self):
+        ''' Swift connection pool for the configured account'''
+        pool_key = (self.config['OS_AUTH_URL'], self.config['OS_APPLICATION_CREDENTIAL_ID'])
+        if pool_key not in self.swift_pools:
+            self.swift_pools[pool_key] = SwiftConnectionPool(
+                swift_connection_from_config(self.config),
+                size=self.config.get('OS_SWIFT_POOL_SIZE', 16)
+            )
+        return self.swift_pools[pool_key]
+
+def _option_flag(options, name):
+    ''' Boolean URI option, None if not set'''
+    if name not in options:
+        return None
+    return options[name].lower() not in ('0', 'false', 'no')
+
+@register_storage('disk')
+def _build_disk_storage(factory, container, path, options):
+    return NtpStorageDisk(
+        data_dir=path or factory.config['TMPDIR'],
+        sharded=_option_flag(options, 'sharded'),
+        fsync=options.get('fsync', factory.config.get('DISK_FSYNC', 'none'))
+    )
+
+@register_storage('gridfs')
+def _build_gridfs_storage(factory, container, path, options):
+    return NtpStorageGridFs(
+        db=factory.get_db(),
+        bucket_name=path or factory.config['documents_col'],
+        compression=options.get('compress', factory.config.get('COMPRESSION'))
+    )
+
+@register_storage('swift')
+def _build_swift_storage(factory, container, path, options):
+    return NtpStorageSwift(
+        swift_pool=factory.get_swift_pool(),
+        swift_container=container or factory.config['OS_SWIFT_CONTAINER'],
+        swift_prefix=path or factory.config['OS_SWIFT_DOCUMENTS_FOLDER'],
+        max_workers=int(options.get('workers', factory.config.get('OS_SWIFT_MAX_WORKERS', 8))),
+        segment_threshold=factory.config.get('OS_SWIFT_SEGMENT_THRESHOLD'),
+        segment_size=factory.config.get('OS_SWIFT_SEGMENT_SIZE'),
+        compression=options.get('compress', factory.config.get('COMPRESSION'))
+    )
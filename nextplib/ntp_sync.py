@@ -0,0 +1,375 @@
+''' Support for incremental syncs between storages '''
+import logging
+import time
+import queue
+import threading
+from datetime import datetime, timedelta
+from mmb_data.mongo_db_bulk_write import MongoDBBulkWrite, CTS
+from nextplib import ntp_storage as ntpst, ntp_utils as nu, ntp_constants as cts, ntp_indexes
+
+def get_pair_key(uri_from, uri_to):
+    ''' Manifest key for an origin/destination pair, URI options are ignored'''
+    return ' -> '.join(
+        ':'.join(str(part) for part in ntpst.parse_storage_uri(uri)[:3])
+        for uri in (uri_from, uri_to)
+    )
+
+def same_contents(info_a, info_b):
+    ''' Compare file information from two listings, unknown sizes or
+        hashes (None) are not compared'''
+    for key in ('size', 'hash'):
+        if info_a.get(key) is not None and info_b.get(key) is not None and info_a[key] != info_b[key]:
+            return False
+    return True
+
+def plan_sync(from_info, to_info, delete=False):
+    ''' Sync plan comparing origin and destination listings ({name: info}).
+        Returns lists of names for ADD (missing at destination), FIX (size
+        or hash differ), SAME (same contents) and DEL (only at destination,
+        empty unless delete)'''
+    plan = {'ADD': [], 'FIX': [], 'SAME': [], 'DEL': []}
+    for file, info in from_info.items():
+        if file not in to_info:
+            plan['ADD'].append(file)
+        elif same_contents(info, to_info[file]):
+            plan['SAME'].append(file)
+        else:
+            plan['FIX'].append(file)
+    if delete:
+        plan['DEL'] = [file for file in to_info if file not in from_info]
+    return plan
+
+def get_id_windows(storage, num_windows, id_range=None):
+    ''' Split id_range into up to num_windows (ini, fin) id windows holding
+        similar numbers of files at storage'''
+    if isinstance(id_range, str) or num_windows < 2:
+        return [id_range]
+    id_min, id_max = id_range if id_range is not None else (None, None)
+    windows = []
+    ini = id_min
+    for bound in storage.file_id_quantiles(num_windows, id_range=id_range):
+        if bound <= (ini or 'ntp00000000'):
+            continue
+        windows.append((ini, 'ntp' + str(nu.parse_ntp_id(bound) - 1).zfill(8)))
+        ini = bound
+    windows.append((ini, id_max))
+    return windows
+
+def new_report():
+    ''' Empty sync report, counts and origin modification times seen'''
+    return {
+        'new': 0,
+        'fix': 0,
+        'same': 0,
+        'to_delete': 0,
+        'transferred': 0,
+        'deleted': 0,
+        'errors': 0,
+        'last_modified': None,
+        'first_failed': None
+    }
+
+def merge_reports(reports):
+    ''' Merge sync reports from several id windows'''
+    merged = new_report()
+    for report in reports:
+        for key, value in report.items():
+            if value is None:
+                continue
+            if key == 'last_modified':
+                merged[key] = value if merged[key] is None else max(merged[key], value)
+            elif key == 'first_failed':
+                merged[key] = value if merged[key] is None else min(merged[key], value)
+            else:
+                merged[key] += value
+    return merged
+
+class SyncManifest:
+    ''' Files already synced between a pair of storages (name, size, hash,
+        sync time) and the high-water mark of origin modification times.
+        Entries are kept at manifest_col, marks at manifest_col.state'''
+    def __init__(self, db, pair, manifest_col='syncManifest', batch_size=1000):
+        self.pair = pair
+        self.entries_col = db.get_collection(manifest_col)
+        self.state_col = db.get_collection(f"{manifest_col}.state")
+        ntp_indexes.ensure_indexes(self.entries_col, 'sync_manifest')
+        self.upserts = MongoDBBulkWrite(self.entries_col, CTS['UPSERT'], batch_size)
+        self.deletes = MongoDBBulkWrite(self.entries_col, CTS['DELETE'], batch_size)
+        self.batch_size = batch_size
+
+    def get_state(self):
+        ''' Manifest state for the pair (high_water_mark, last_full)'''
+        return self.state_col.find_one({'_id': self.pair}) or {}
+
+    def high_water_mark(self):
+        ''' Origin modification time up to which files are synced, None if unknown'''
+        return self.get_state().get('high_water_mark')
+
+    def listing_mark(self):
+        ''' Time to list origin changes from, allowing for SYNC_HWM_MARGIN'''
+        mark = self.high_water_mark()
+        if mark is None:
+            return None
+        return mark - timedelta(seconds=cts.SYNC_HWM_MARGIN)
+
+    def set_high_water_mark(self, mark, full=False):
+        ''' Store a new high-water mark, and the time of a full reconcile'''
+        values = {'high_water_mark': mark}
+        if full:
+            values['last_full'] = datetime.utcnow()
+        self.state_col.update_one({'_id': self.pair}, {'$set': values}, upsert=True)
+
+    def get_entries(self, file_names):
+        ''' Manifest entries for file_names, as {name: entry}'''
+        file_names = list(file_names)
+        entries = {}
+        for pos in range(0, len(file_names), self.batch_size):
+            for entry in self.entries_col.find(
+                    {'pair': self.pair, 'name': {'$in': file_names[pos:pos + self.batch_size]}},
+                    projection={'_id': 0, 'name': 1, 'size': 1, 'hash': 1, 'synced': 1}
+                ):
+                entries[entry['name']] = entry
+        return entries
+
+    def get_all(self, id_range=None):
+        ''' All manifest entries within id_range, as {name: entry}'''
+        entries = {}
+        query = {'pair': self.pair}
+        if ntpst.get_filename_range(id_range) is not None:
+            query['name'] = ntpst.get_filename_range(id_range)
+        for entry in self.entries_col.find(
+                query,
+                projection={'_id': 0, 'name': 1, 'size': 1, 'hash': 1, 'synced': 1}
+            ):
+            if ntpst.is_in_range(ntpst.get_ntpid(entry['name']), id_range):
+                entries[entry['name']] = entry
+        return entries
+
+    @staticmethod
+    def is_synced(file_info, entry):
+        ''' Check whether origin file_info is already synced according to entry'''
+        return entry is not None and\
+            entry.get('size') == file_info['size'] and\
+            entry.get('hash') == file_info['hash']
+
+    def record(self, file_info):
+        ''' Mark file as synced (buffered, see flush)'''
+        self.upserts.append(
+            {'pair': self.pair, 'name': file_info['name']},
+            {'$set': {
+                'size': file_info['size'],
+                'hash': file_info['hash'],
+                'synced': datetime.utcnow()
+            }}
+        )
+        self.upserts.commit_data_if_full()
+
+    def remove(self, file_name):
+        ''' Remove file from manifest (buffered, see flush)'''
+        self.deletes.append({'pair': self.pair, 'name': file_name}, None)
+        self.deletes.commit_data_if_full()
+
+    def flush(self):
+        ''' Write pending manifest changes'''
+        self.upserts.commit_any_data()
+        self.deletes.commit_any_data()
+
+class CountingReader:
+    ''' File-like wrapper counting the bytes read from stream. length is
+        the size of stream if known, or the size given (from a listing)'''
+    def __init__(self, stream, length=None):
+        self.stream = stream
+        self.length = ntpst.get_stream_size(stream)
+        if self.length is None:
+            self.length = length
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        return data
+
+class ByteBudget:
+    ''' Limit on bytes of transfers in progress between readers and writers.
+        A single item larger than the limit is let through when nothing
+        else is in flight'''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        with self._cond:
+            while self.in_flight and self.in_flight + size > self.max_bytes:
+                self._cond.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self._cond:
+            self.in_flight -= size
+            self._cond.notify_all()
+
+class TransferEngine:
+    ''' Pipelined transfer between storages: reader threads open documents
+        at origin, writer threads stream them to destination. Transfers in
+        progress are bounded by max_bytes, according to the listing sizes.
+        Each open and store is retried with exponential backoff. Storages
+        able to copy between them server-side skip the reader/writer pipeline'''
+    def __init__(self, from_storage, to_storage, **kwargs):
+        self.from_storage = from_storage
+        self.to_storage = to_storage
+        self.readers = kwargs.get('readers', 4)
+        self.writers = kwargs.get('writers', 4)
+        self.budget = ByteBudget(kwargs.get('max_bytes', cts.SYNC_MAX_BYTES_IN_FLIGHT))
+        self.retries = kwargs.get('retries', cts.SYNC_RETRIES)
+        self.backoff = kwargs.get('backoff', cts.SYNC_BACKOFF)
+        self.progress_interval = kwargs.get('progress_interval', 10)
+        self.sizes = {}
+        self.stored = []
+        self.failed = []
+        self.bytes_stored = 0
+        self._lock = threading.Lock()
+
+    def _retry(self, action, file_name, func):
+        ''' Run func, retrying with backoff. Returns its result, None if all attempts fail'''
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except Exception as err:
+                logging.debug(err)
+                if attempt < self.retries:
+                    logging.debug(f"{action} {file_name} failed, retrying")
+                    time.sleep(self.backoff * 2 ** attempt)
+        logging.error(f"Error {action} {file_name}")
+        return None
+
+    def _open(self, file_name):
+        stream = self.from_storage.file_open(file_name)
+        # Storages report read errors returning None
+        if stream is None:
+            raise IOError(f"{file_name} not available at origin")
+        return stream
+
+    def _store(self, file_name, streams):
+        ''' Stream file_name to destination, using the stream opened by the
+            reader on the first attempt and a new one on retries. Returns
+            the number of bytes transferred'''
+        stream = streams.pop() if streams else self._open(file_name)
+        try:
+            reader = CountingReader(stream, self.sizes.get(file_name))
+            self.to_storage.file_store(file_name, reader)
+            return reader.size
+        finally:
+            stream.close()
+
+    def _copy(self, file_name):
+        self.to_storage.copy_file(self.from_storage, file_name)
+        return True
+
+    def _run_copy(self, file_names, start):
+        ''' Server-side copies, issued concurrently by readers + writers threads'''
+        last_progress = start
+        for file_name, copied in ntpst.bounded_map(
+                lambda file_name: self._retry('copying', file_name, lambda: self._copy(file_name)),
+                file_names,
+                max_workers=self.readers + self.writers
+            ):
+            self._add_result(file_name, 0 if copied else None)
+            if time.time() - last_progress > self.progress_interval:
+                logging.info(self.progress(len(file_names), start))
+                last_progress = time.time()
+        logging.info(self.progress(len(file_names), start))
+        return self.stored, self.failed
+
+    def _reader(self, names_queue, data_queue):
+        while True:
+            file_name = names_queue.get()
+            if file_name is None:
+                return
+            size = self.sizes.get(file_name) or 0
+            self.budget.acquire(size)
+            stream = self._retry('reading', file_name, lambda: self._open(file_name))
+            if stream is None:
+                self.budget.release(size)
+                self._add_result(file_name, None)
+                continue
+            data_queue.put((file_name, stream, size))
+
+    def _writer(self, data_queue):
+        while True:
+            item = data_queue.get()
+            if item is None:
+                return
+            file_name, stream, size = item
+            streams = [stream]
+            stored = self._retry('storing', file_name, lambda: self._store(file_name, streams))
+            if streams:
+                streams.pop().close()
+            self.budget.release(size)
+            self._add_result(file_name, stored)
+
+    def _add_result(self, file_name, size):
+        with self._lock:
+            if size is None:
+                self.failed.append(file_name)
+            else:
+                logging.debug(f"{file_name} transferred")
+                self.stored.append(file_name)
+                self.bytes_stored += size
+
+    def progress(self, total, start):
+        ''' Progress line: files done, files/sec and MB/sec'''
+        elapsed = max(time.time() - start, 1e-6)
+        with self._lock:
+            n_stored = len(self.stored)
+            n_failed = len(self.failed)
+            bytes_stored = self.bytes_stored
+        return (
+            f"{n_stored + n_failed}/{total} files, {n_failed} errors, "
+            f"{n_stored / elapsed:.1f} files/s, {bytes_stored / elapsed / 1024 / 1024:.2f} MB/s, "
+            f"{self.budget.in_flight / 1024 / 1024:.1f} MB in flight"
+        )
+
+    def run(self, file_names, sizes=None):
+        ''' Transfer file_names, returns (stored, failed) lists of names.
+            sizes ({name: size} from the origin listing) are reserved from
+            max_bytes while each file is transferred, unknown sizes as 0'''
+        file_names = list(file_names)
+        self.sizes = sizes or {}
+        self.stored = []
+        self.failed = []
+        self.bytes_stored = 0
+        if self.to_storage.can_copy_from(self.from_storage):
+            logging.info("Destination can copy from Origin server-side, using server-side copies")
+            return self._run_copy(file_names, time.time())
+        names_queue = queue.Queue()
+        for file_name in file_names:
+            names_queue.put(file_name)
+        for num in range(self.readers):
+            names_queue.put(None)
+        data_queue = queue.Queue()
+        readers = [
+            threading.Thread(target=self._reader, args=(names_queue, data_queue), daemon=True)
+            for num in range(self.readers)
+        ]
+        writers = [
+            threading.Thread(target=self._writer, args=(data_queue,), daemon=True)
+            for num in range(self.writers)
+        ]
+        start = time.time()
+        for thread in readers + writers:
+            thread.start()
+        for thread in readers:
+            while thread.is_alive():
+                thread.join(self.progress_interval)
+                if thread.is_alive():
+                    logging.info(self.progress(len(file_names), start))
+        for num in range(self.writers):
+            data_queue.put(None)
+        for thread in writers:
+            while thread.is_alive():
+                thread.join(self.progress_interval)
+                if thread.is_alive():
+                    logging.info(self.progress(len(file_names), start))
+        logging.info(self.progress(len(file_names), start))
+        return self.stored, self.failed
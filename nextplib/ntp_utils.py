@@ -18,6 +18,13 @@ def parse_ntp_id(ntp_id):
     '''
     return int(ntp_id.replace('ntp',''))
 
+def get_ntp_id(ntp_order):
+    ''' Get ntp_id from document order
+        Parameters:
+            ntp_order (int)
+    '''
+    return 'ntp{:s}'.format(str(ntp_order).zfill(8))
+
 def check_ntp_id(ntp_id):
     ''' Check ntp id syntax
         Parameters:
@@ -0,0 +1,118 @@
+''' Materialized version chains of place collections '''
+import logging
+from mmb_data.mongo_db_bulk_write import MongoDBBulkWrite, CTS
+from nextplib import ntp_utils as nu, ntp_indexes
+
+class VersionIndex:
+    ''' Version chains of a place collection, kept at <col>_versions as
+        {_id: place id, active: ntp id, obsolete: [ntp ids], ids: [all ntp ids],
+        updated: [YYYY-MM-DD HH:MM:SS]}. Any ntp id is resolved to its
+        active version with a single lookup on the ids index'''
+    def __init__(self, db, col_name, batch_size=1000):
+        self.col_name = col_name
+        self.col = db.get_collection(f"{col_name}_versions")
+        # Changes from batch scripts are buffered, see flush
+        self.upserts = MongoDBBulkWrite(self.col, CTS['UPSERT'], batch_size)
+        self.updates = MongoDBBulkWrite(self.col, CTS['UPDATE'], batch_size)
+
+    def ensure_indexes(self):
+        ''' Index on all ntp ids of each chain'''
+        ntp_indexes.ensure_indexes(self.col, 'versions')
+
+    def get(self, place_id):
+        ''' Version chain of place_id, None if not indexed'''
+        return self.col.find_one({'_id': place_id})
+
+    def get_active(self, place_id):
+        ''' Active ntp id for place_id, None if not indexed'''
+        chain = self.col.find_one({'_id': place_id}, projection={'active': 1})
+        if chain is None:
+            return None
+        return chain['active']
+
+    def resolve(self, ntp_id):
+        ''' Active version of ntp_id (itself if active), None if not indexed'''
+        chain = self.col.find_one({'ids': ntp_id}, projection={'active': 1})
+        if chain is None:
+            return None
+        return chain['active']
+
+    def update(self, place_id, active_id, obsolete_ids, updated):
+        ''' Store the version chain of place_id after ingesting a new version'''
+        chain = get_chain(active_id, obsolete_ids, updated)
+        self.col.replace_one({'_id': place_id}, chain, upsert=True)
+
+    def store(self, place_id, active_id, obsolete_ids, updated):
+        ''' Store the version chain of place_id (buffered, see flush)'''
+        # Buffers are written in the order changes were made
+        self.updates.commit_any_data()
+        self.upserts.append({'_id': place_id}, {'$set': get_chain(active_id, obsolete_ids, updated)})
+        self.upserts.commit_data_if_full()
+
+    def add_obsolete(self, place_id, obsolete_ids):
+        ''' Add obsolete_ids to the version chain of place_id, if indexed
+            (buffered, see flush)'''
+        self.upserts.commit_any_data()
+        self.updates.append(
+            {'_id': place_id},
+            {'$addToSet': {'obsolete': {'$each': obsolete_ids}, 'ids': {'$each': obsolete_ids}}}
+        )
+        self.updates.commit_data_if_full()
+
+    def flush(self):
+        ''' Write pending chain changes'''
+        self.upserts.commit_any_data()
+        self.updates.commit_any_data()
+
+    def rebuild(self, incoming_col, batch_size=1000):
+        ''' Build the index from a full scan of incoming_col, grouped by place id
+            on the server. Returns number of chains stored'''
+        bulk = MongoDBBulkWrite(self.col, CTS['UPSERT'], batch_size)
+        num_chains = 0
+        for group in incoming_col.aggregate([
+                {'$project': {'id': 1, 'obsolete_version': 1, 'updated': 1}},
+                {'$sort': {'_id': 1}},
+                {'$group': {
+                    '_id': '$id',
+                    'versions': {'$push': {
+                        'ntp_id': '$_id',
+                        'obsolete': '$obsolete_version',
+                        'updated': '$updated'
+                    }}
+                }}
+            ], allowDiskUse=True):
+            if group['_id'] is None:
+                continue
+            active = [vers for vers in group['versions'] if not vers.get('obsolete')]
+            if not active:
+                logging.warning(f"{group['_id']}: no active version found")
+                continue
+            if len(active) > 1:
+                logging.warning(f"{group['_id']}: {len(active)} active versions, using {active[-1]['ntp_id']}")
+            updated = []
+            for vers in active:
+                if vers.get('updated'):
+                    updated = nu.merge_updates(vers['updated'], updated)
+            bulk.append(
+                {'_id': group['_id']},
+                {'$set': get_chain(
+                    active[-1]['ntp_id'],
+                    [vers['ntp_id'] for vers in group['versions']],
+                    updated
+                )}
+            )
+            bulk.commit_data_if_full()
+            num_chains += 1
+        bulk.commit_any_data()
+        self.ensure_indexes()
+        return num_chains
+
+def get_chain(active_id, obsolete_ids, updated):
+    ''' Version chain document, obsolete ids in order and normalized update dates'''
+    obsolete = sorted(set(obsolete_ids).difference([active_id]))
+    return {
+        'active': active_id,
+        'obsolete': obsolete,
+        'ids': obsolete + [active_id],
+        'updated': nu.merge_updates(updated or [], [])
+    }
@@ -22,7 +22,7 @@ import argparse
 import logging
 import json
 from yaml import load, CLoader
-from nextplib import ntp_entry as ntp, ntp_constants as cts, ntp_utils as nu
+from nextplib import ntp_entry as ntp, ntp_constants as cts, ntp_utils as nu, ntp_versions
 from mmb_data.mongo_db_connect import Mongo_db
 
 def main():
@@ -61,6 +61,7 @@ def main():
     logging.info(f"Connected to {config['MONGODB_DB']}")
     place_cols = [db_lnk.db.get_collection(config["outsiders_col_prefix"]), db_lnk.db.get_collection(config["minors_col_prefix"])]
     logging.debug(f"Place collections: {place_cols}")
+    version_indexes = [ntp_versions.VersionIndex(db_lnk.db, col.name) for col in place_cols]
 
 
     for file in args.json_files:
@@ -78,15 +79,14 @@ def main():
                 if data['procurement_id'] not in processed_docs:
                     logging.debug(f"Processing {data['procurement_id']}")
                     col = place_cols[nu.get_group(data['procurement_id'])]
+                    version_index = version_indexes[nu.get_group(data['procurement_id'])]
                     ref_doc = ntp.NtpEntry()
-                    ref_doc.load_from_db(col, data['procurement_id'])
-                    if ref_doc.is_obsolete():
-                        active_doc_id = nu.get_active_version(ref_doc.data['id'], col)
-                        logging.warning(f"Document {data['procurement_id']} is obsolete, active version is {active_doc_id}")
-                        ref_doc.load_from_db(col, active_doc_id)
-                        if not ref_doc:
-                            logging.error(f"Active version {active_doc_id} not found")
-                            continue
+                    # Obsolete documents are replaced by their active version
+                    if not ref_doc.load_from_db(col, data['procurement_id'], follow_version=True, version_index=version_index):
+                        logging.error(f"Document {data['procurement_id']} or its active version not found")
+                        continue
+                    if ref_doc.ntp_id != data['procurement_id']:
+                        logging.warning(f"Document {data['procurement_id']} is obsolete, active version is {ref_doc.ntp_id}")
                     else:
                         logging.info(f"Document {data['procurement_id']} is active")
                     processed_docs[data['procurement_id']] = ref_doc.ntp_id
@@ -22,10 +22,8 @@ options:
 import sys
 import argparse
 import logging
-import os
-import time
 from yaml import load, CLoader
-from nextplib import ntp_entry as ntp, ntp_storage as ntpst, ntp_constants as cts, ntp_utils as nu
+from nextplib import ntp_storage as ntpst, ntp_constants as cts, ntp_utils as nu, ntp_indexes
 from mmb_data.mongo_db_connect import Mongo_db
 
 def main():
@@ -68,57 +66,79 @@ def main():
     logging.info(f"Selecting collection {incoming_col.name}")
 
     logging.info(f"Using GridFS storage at {config['MONGODB_HOST']}")
-    storage = ntpst.NtpStorageGridFs(gridfs_obj=db_lnk.get_gfs(config['documents_col']))
-    backup_storage = ntpst.NtpStorageGridFs(gridfs_obj=db_lnk.get_gfs(config['documents_backup_col']))
-    files_col = db_lnk.db.get_collection(config['documents_col'] + '.files')
-    backup_files_col = db_lnk.db.get_collection(config['documents_backup_col'] + '.files')
+    factory = ntpst.StorageFactory(config, db_lnk=db_lnk)
+    storage = factory.get_storage(f"gridfs:{config['documents_col']}")
+    backup_storage = factory.get_storage(f"gridfs:{config['documents_backup_col']}")
 
     if args.verbose:
         logging.info("Getting obsolete ids...")
 
     for ntp_id in (args.id, args.ini, args.fin):
-        if ntp_id is not None and not ntp.check_ntp_id(ntp_id):
+        if ntp_id is not None and not nu.check_ntp_id(ntp_id):
             logging.error(f'{ntp_id} is not a valid ntp id')
             sys.exit()
 
-    if args.id is not None:
-        query = {'_id': args.id}
-    else:
-        query = [{'obsolete_version': {'$exists':1}}]
-        if args.ini is not None:
-            query.append({'_id':{'$gte': args.ini}})
-        if args.fin is not None:
-            query.append({'_id':{'$lte': args.fin}})
-        query = {'$and': query}
-
-    num_ids = 0
-    num_del = 0
+    query = get_query(args)
+    if args.id is None:
+        ntp_indexes.check_query(incoming_col, query, sort=[('_id', 1)])
+
+    id_range = nu.get_id_range(args)
+    recover_ids = []
 
-    for doc in list(incoming_col.find(query, {'_id':1, 'obsolete_version':1})):
-        ntp_id = doc['_id']
-        if not doc['obsolete_version']:
-            logging.warning(f"{ntp_id} is not marked as obsolete")
-            if args.recover_backup:
-                for file in backup_storage.file_list_per_doc(backup_files_col, ntp_id):
-                    if not args.dry_run:
-                        storage.file_store(file['filename'], backup_storage.file_read(file['filename']))
-                    logging.info(f"Recovered {file['filename']}")
-                continue
-        if args.verbose:
-            logging.info(f'Processing {ntp_id}')
-        for file in storage.file_list_per_doc(files_col, ntp_id):
-            if not args.no_backup:
-                if not args.dry_run:
-                    backup_storage.file_store(file['filename'], storage.file_read(file['filename']))
+    # Files of obsolete versions, from a merge join of obsolete ids and files sorted by name
+    num_del = 0
+    obsolete_ids = get_obsolete_ids(incoming_col, query, recover_ids, args.verbose)
+    for batch in ntpst.iter_batches(storage.files_for_ids(obsolete_ids, id_range), cts.DELETE_BATCH):
+        file_names = [file['filename'] for file in batch]
+        if not args.no_backup and not args.dry_run:
+            # Server-side copy of files and chunks to the backup bucket
+            backup_storage.copy_ids_from(storage, [file['_id'] for file in batch])
+        num_del += purge_files(storage, file_names, args.dry_run)
+
+    if args.recover_backup:
+        for batch in ntpst.iter_batches(backup_storage.files_for_ids(recover_ids, id_range), cts.DELETE_BATCH):
             if not args.dry_run:
-                storage.delete_file(file['filename'])
-            logging.info(f"Deleted {file['filename']}")
-            num_del += 1
+                storage.copy_ids_from(backup_storage, [file['_id'] for file in batch])
+            for file in batch:
+                logging.info(f"Recovered {file['filename']}")
 
-        num_ids += 1
+    if args.verbose:
+        logging.info(f"{num_del} files deleted")
 
+def get_query(args):
+    ''' Query selecting the document given with --id, or obsolete
+        versions in the --ini/--fin range'''
+    if args.id is not None:
+        return {'_id': args.id}
+    query = [{'obsolete_version': {'$exists':1}}]
+    if args.ini is not None:
+        query.append({'_id':{'$gte': args.ini}})
+    if args.fin is not None:
+        query.append({'_id':{'$lte': args.fin}})
+    return {'$and': query}
+
+def get_obsolete_ids(incoming_col, query, recover_ids, verbose=False):
+    ''' Obsolete ids in _id order, non obsolete ones are added to recover_ids'''
+    for doc in incoming_col.find(query, {'_id':1, 'obsolete_version':1}, sort=[('_id', 1)]):
+        if not doc.get('obsolete_version'):
+            logging.warning(f"{doc['_id']} is not marked as obsolete")
+            recover_ids.append(doc['_id'])
+            continue
+        if verbose:
+            logging.info(f"Processing {doc['_id']}")
+        yield doc['_id']
+
+def purge_files(storage, file_names, dry_run=False):
+    ''' Delete file_names from storage, returns number of files deleted'''
+    if not file_names:
+        return 0
+    if dry_run:
+        for file_name in file_names:
+            logging.info(f"Deleted {file_name} (dry run)")
+        return len(file_names)
+    num_del = storage.delete_many(file_names)
+    logging.info(f"Deleted {num_del} files ({file_names[0]} ... {file_names[-1]})")
+    return num_del
 
-    if args.verbose:
-        logging.info(f"Processed {num_ids} entries")
 if __name__ == "__main__":
     main()
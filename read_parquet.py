@@ -26,7 +26,7 @@ import argparse
 import logging
 import pandas as pd
 from yaml import load, CLoader
-from nextplib import ntp_entry as ntp, ntp_constants as cts, ntp_utils as nu
+from nextplib import ntp_entry as ntp, ntp_constants as cts, ntp_utils as nu, ntp_versions, ntp_indexes
 from mmb_data.mongo_db_connect import Mongo_db
 
 def main():
@@ -67,6 +67,7 @@ def main():
     )
 
     incoming_col = db_lnk.db.get_collection(config[f'{args.group}_col_prefix'])
+    version_index = ntp_versions.VersionIndex(db_lnk.db, incoming_col.name)
 
     data_table = pd.read_parquet(args.pkt_file, use_nullable_dtypes=True)
     new_cols = pd.read_csv(args.codes_file, sep='\t', index_col='ORIGINAL')
@@ -75,11 +76,15 @@ def main():
     if args.drop:
         logging.info("Dropping previously stored data")
         incoming_col.drop()
+        version_index.col.drop()
         id_num = cts.MIN_ORDER(args.group)
     else:
         id_num = nu.get_last_order(args.group, incoming_col)
 
     logging.info(f"Last reference found {id_num}")
+    version_index.ensure_indexes()
+    # Versions are searched by place id for every row
+    ntp_indexes.check_query(incoming_col, {'id': ''})
 
     n_procs = 0
     for i in range(len(data_table.index)):
@@ -113,9 +118,15 @@ def main():
             if vers['_id'] == selected_id:
                 continue
             vers_obs = ntp.NtpEntry(ntp_id=vers['_id'], place_id=vers['id'])
-            vers_obs.make_obsolete(new_doc.ntp_id)
+            vers_obs.make_obsolete(selected_id)
             logging.info(f"Updating obsolete {vers['_id']}")
             vers_obs.commit_to_db(incoming_col, update=False)
+        version_index.update(
+            new_data['id'],
+            selected_id,
+            [vers['_id'] for vers in versions],
+            new_data['updated']
+        )
 
         if args.verbose:
             logging.info(f"Processed {selected_id}")
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+''' Script to move documents in a flat disk folder into the sharded layout
+    usage: reshard_disk.py [-h] [-v] [--debug] [--dry_run] folder
+
+Reshard disk storage
+
+positional arguments:
+  folder         Disk storage folder
+
+options:
+  -h, --help     show this help message and exit
+  -v, --verbose  Extra progress information
+  --debug        Extra debug information
+  --dry_run      Do not move files, just count them
+'''
+import sys
+import argparse
+import logging
+import os
+from nextplib import ntp_storage as ntpst
+
+def main():
+    ''' Main '''
+    parser = argparse.ArgumentParser(description='Reshard disk storage')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Extra progress information')
+    parser.add_argument('--debug',action='store_true', help='Extra debug information')
+    parser.add_argument('--dry_run', action='store_true', help='Do not move files, just count them')
+    parser.add_argument('folder', help='Disk storage folder')
+
+    args = parser.parse_args()
+    # Setup logging
+    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
+    if args.debug:
+        logging.getLogger().setLevel(10)
+    else:
+        logging.getLogger().setLevel(20)
+
+    if not os.path.isdir(args.folder):
+        logging.error(f"{args.folder} does not exist, exiting")
+        sys.exit(1)
+
+    storage = ntpst.NtpStorageDisk(data_dir=args.folder)
+    if storage.sharded:
+        logging.info(f"{args.folder} already sharded, moving remaining flat files")
+    if args.verbose:
+        logging.info(f"Resharding {args.folder}")
+    num_moved = storage.reshard(dry_run=args.dry_run)
+    if args.dry_run:
+        logging.info(f"{num_moved} files to move (--dry_run)")
+    else:
+        logging.info(f"{num_moved} files moved to shard folders")
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@
     usage: sync_documents.py [-h] [--ini INI] [--fin FIN] [--id ID]
                         [-i FOLDER_IN] [-o FOLDER_OUT] [--config CONFIG]
                          [--delete] [--replace] [-v] [--debug] [--check_only]
+                         [--patch_list PATCH_LIST] [--incremental] [--full]
+                         [--readers READERS] [--writers WRITERS] [--max_inflight MAX_INFLIGHT]
+                         [--shards SHARDS]
 
 Sync documents between storages
 
@@ -13,42 +16,37 @@ options:
   --fin FIN             Final document range
   --id ID               Selected document id
   -i FOLDER_IN, --folder_in FOLDER_IN
-                        Selected Origin (local folder|gridfs:|container@swift:folder)
+                        Selected Origin (local folder|gridfs:[bucket]|container@swift:folder, optional ?option=value)
   -o FOLDER_OUT, --folder_out FOLDER_OUT
-                        Selected Destination (local folder|gridfs:|container@swift:folder)
+                        Selected Destination (local folder|gridfs:[bucket]|container@swift:folder, optional ?option=value)
   --config CONFIG       Configuration file (default;secrets.yml)
   --delete              Delete files at destination that are not present at Origin
   --replace             Replace existing files
   -v, --verbose         Extra progress information
   --debug               Extra debug information
   --check_only          Check only, no transfer
+  --patch_list PATCH_LIST
+                        Prepare a listing of modifications
+  --incremental         Sync only files changed at Origin since last sync (sync manifest)
+  --full                Full comparison, rebuilds sync manifest
+  --readers READERS     Parallel reads from Origin (default: 4)
+  --writers WRITERS     Parallel writes to Destination (default: 4)
+  --max_inflight MAX_INFLIGHT
+                        Max. MB read and pending to store (default: 256)
+  --shards SHARDS       Split id range in SHARDS balanced windows synced in parallel processes
 '''
 
 import sys
 import argparse
 import logging
 import os
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from yaml import load, CLoader
-import swiftclient as sw
-from nextplib import ntp_entry as ntp, ntp_storage as ntpst, ntp_utils as nu, ntp_constants as cts
+from nextplib import ntp_entry as ntp, ntp_storage as ntpst, ntp_sync, ntp_utils as nu, ntp_constants as cts
 from mmb_data.mongo_db_connect import Mongo_db
 
-def parse_folder_str(folder):
-    container = None
-    where_folder = None
-    if ':' not in folder:
-        where_from = 'disk'
-        where_folder = folder
-    elif folder == 'gridfs:':
-        where_from = 'gridfs'
-    elif 'swift:' in folder:
-        container, path = folder.split('@', 1)
-        where_from, where_folder = path.split(':', 1)
-    else:
-        logging.error(f"Not recognized folder {folder}")
-        sys.exit(1)
-    return where_from, where_folder, container
-
 def main():
     ''' Main '''
 
@@ -56,8 +54,8 @@ def main():
     parser.add_argument('--ini', action='store', help='Initial document range')
     parser.add_argument('--fin', action='store', help='Final document range')
     parser.add_argument('--id', action='store', help='Selected document id')
-    parser.add_argument('-i', '--folder_in', action='store', help='Selected Origin (local folder|gridfs:|container@swift:folder)')
-    parser.add_argument('-o', '--folder_out', action='store', help='Selected Destination (local folder|gridfs:|container@swift:folder)')
+    parser.add_argument('-i', '--folder_in', action='store', help='Selected Origin (local folder|gridfs:[bucket]|container@swift:folder, optional ?option=value)')
+    parser.add_argument('-o', '--folder_out', action='store', help='Selected Destination (local folder|gridfs:[bucket]|container@swift:folder, optional ?option=value)')
     parser.add_argument('--config', action='store', default='secrets.yml', help='Configuration file (default;secrets.yml)')
     parser.add_argument('--delete',action='store_true', help='Delete files at destination that are not present at Origin')
     parser.add_argument('--replace', action='store_true', help='Replace existing files')
@@ -65,6 +63,12 @@ def main():
     parser.add_argument('--debug',action='store_true', help='Extra debug information')
     parser.add_argument('--check_only',action='store_true', help='Check only, no transfer')
     parser.add_argument('--patch_list', action='store', help='Prepare a listing of modifications')
+    parser.add_argument('--incremental', action='store_true', help='Sync only files changed at Origin since last sync (sync manifest)')
+    parser.add_argument('--full', action='store_true', help='Full comparison, rebuilds sync manifest')
+    parser.add_argument('--readers', action='store', type=int, default=4, help='Parallel reads from Origin (default: 4)')
+    parser.add_argument('--writers', action='store', type=int, default=4, help='Parallel writes to Destination (default: 4)')
+    parser.add_argument('--shards', action='store', type=int, default=1, help='Split id range in SHARDS balanced windows synced in parallel processes')
+    parser.add_argument('--max_inflight', action='store', type=int, default=cts.SYNC_MAX_BYTES_IN_FLIGHT // 1024 // 1024, help='Max. MB read and pending to store (default: 256)')
 
     args = parser.parse_args()
     # Setup logging
@@ -93,88 +97,10 @@ def main():
     if args.verbose:
         logging.info("Connecting to storage...")
 
-    where_from, from_folder, container_from = parse_folder_str(args.folder_in)
-    where_to, to_folder, container_to = parse_folder_str(args.folder_out)
+    from_storage, to_storage = get_storages(args, config, db_lnk)
 
-    log_message_i = log_message_o = ''
-
-    if where_from == 'disk' or where_to == 'disk':
-        if where_from == 'disk':
-            if from_folder is None:
-                from_folder = config['TMPDIR']
-            else:
-                from_folder = args.from_folder
-            if not os.path.isdir(from_folder):
-                logging.error(f"{from_folder} does not exist, exiting")
-                sys.exit(1)
-            from_storage = ntpst.NtpStorageDisk(data_dir=from_folder)
-            log_message_i = f"Using Origin disk storage at {from_folder}"
-
-        if where_to == 'disk':
-            if to_folder is None:
-                to_folder = config['TMPDIR']
-
-            if to_folder == from_folder:
-                logging.error("Origin and Destination folders are the same, exiting")
-                sys.exit()
-
-            log_message_o = f"Using Destination disk storage at {to_folder}"
-            if not os.path.isdir(to_folder):
-                try:
-                    os.mkdir(to_folder)
-                    logging.info(f"{to_folder} non existent, created")
-                except Exception as err:
-                    sys.exit(f"Error creating {to_folder} {err}")
-            to_storage = ntpst.NtpStorageDisk(data_dir=to_folder)
-
-    if where_from == 'gridfs' or where_to == 'gridfs':
-        if where_from == where_to:
-            logging.error("Origin and destination points to gridFS, exiting")
-            sys.error(1)
-        if where_from == 'gridfs':
-            log_message_i = f"Using Origin GridFS storage at {config['MONGODB_HOST']}"
-            from_storage = ntpst.NtpStorageGridFs(gridfs_obj=db_lnk.get_gfs(config['documents_col']))
-            from_folder = config['documents_col']
-        if where_to == 'gridfs':
-            log_message_o = f"Using Destination GridFS storage at {config['MONGODB_HOST']}"
-            to_storage = ntpst.NtpStorageGridFs(gridfs_obj=db_lnk.get_gfs(config['documents_col']))
-            to_folder = config['documents_col']
-
-    if where_from == 'swift' or where_to == 'swift':
-        if where_from == where_to and from_folder == to_folder:
-            logging.error("Origin and destination to Swift coincident, exiting")
-            sys.error(1)
-
-        swift_conn = sw.Connection(
-            authurl=config['OS_AUTH_URL'],
-            auth_version=3,
-            os_options={
-                'auth_type': config['OS_AUTH_TYPE'],
-                'region_name': config['OS_REGION_NAME'],
-                'application_credential_id': config['OS_APPLICATION_CREDENTIAL_ID'],
-                'application_credential_secret': config['OS_APPLICATION_CREDENTIAL_SECRET'],
-                'service_project_name': config['OS_PROJECT_NAME']
-            }
-        )
-        if where_from == 'swift':
-            if from_folder is None:
-                from_folder = config['OS_SWIFT_DOCUMENTS_FOLDER']
-            from_storage = ntpst.NtpStorageSwift(
-                swift_connection=swift_conn,
-                swift_container=container_from,
-                swift_prefix=from_folder
-            )
-            log_message_i = f"Using Origin Swift storage at {container_from}:{from_folder}"
-
-        if where_to == 'swift':
-            if to_folder is None:
-                to_folder = config['OS_SWIFT_DOCUMENTS_FOLDER']
-            to_storage = ntpst.NtpStorageSwift(
-                swift_connection=swift_conn,
-                swift_container=container_to,
-                swift_prefix=to_folder
-            )
-            log_message_o = f"Using Destination Swift storage at {container_to}:{to_folder}"
+    log_message_i = f"Using Origin {from_storage.type} storage at {args.folder_in}"
+    log_message_o = f"Using Destination {to_storage.type} storage at {args.folder_out}"
 
     if args.verbose:
         logging.info(log_message_i)
@@ -196,89 +122,251 @@ def main():
             query.append({'_id':{'$lte': args.fin}})
         query = {'$and': query}
 
+    id_range = nu.get_id_range(args)
     if args.verbose:
-        logging.info(f"id_range: {nu.get_id_range(args)}")
-
-    from_files = set(from_storage.file_list(
-        id_range=nu.get_id_range(args),
-        set_debug=args.debug
-    ))
-    logging.info(f"Origin: {len(from_files)} Files available at {args.folder_in} ")
-
-    to_files = set(to_storage.file_list(
-        id_range=nu.get_id_range(args),
-        set_debug=args.debug
-    ))
-    logging.info(f"Destination: {len(to_files)} Files available at {args.folder_out} ")
-
-    new_files = []
-    exist_files = []
-    for file in from_files:
-        if file not in to_files:
-            new_files.append(file)
-        else:
-            exist_files.append(file)
-
-    logging.info(f"{len(new_files)} new files at Origin")
-    if args.replace:
-        logging.info(f"{len(exist_files)} existing files at Destination")
+        logging.info(f"id_range: {id_range}")
+
+    manifest = None
+    since = None
+    if args.incremental or args.full:
+        manifest = get_manifest(args, config, db_lnk)
+        if not args.full:
+            since = manifest.listing_mark()
+            if since is None:
+                logging.info("No previous sync found in manifest, running a full sync")
+
+    if args.shards > 1:
+        windows = ntp_sync.get_id_windows(from_storage, args.shards, id_range)
+        logging.info(f"Syncing {len(windows)} id windows: {windows}")
+        patch_lists = [
+            f"{args.patch_list}.{num}" if args.patch_list else None
+            for num in range(len(windows))
+        ]
+        # Workers rebuild storages and connections from the URIs
+        with ProcessPoolExecutor(max_workers=len(windows), mp_context=multiprocessing.get_context('spawn')) as executor:
+            reports = list(executor.map(
+                sync_window,
+                [args] * len(windows),
+                [config] * len(windows),
+                [since] * len(windows),
+                windows,
+                patch_lists
+            ))
+        report = ntp_sync.merge_reports(reports)
+        if args.patch_list:
+            with open(args.patch_list, 'w') as patch_file:
+                for part in patch_lists:
+                    with open(part, 'r') as part_file:
+                        shutil.copyfileobj(part_file, patch_file)
+                    os.remove(part)
+    else:
+        report = sync_range(args, from_storage, to_storage, manifest, since, id_range, args.patch_list)
+
+    if args.check_only:
+        logging.info(f"no action done (--check_only)")
+        return
+
+    # Marks cover the whole id space, ranged runs do not move them
+    if manifest is not None and id_range is None:
+        update_mark(manifest, report, full=since is None)
+
+    logging.info(
+        f"Transfer completed. {report['transferred']} files transferred, "
+        f"{report['deleted']} files deleted, {report['errors']} errors found"
+    )
+
+def get_manifest(args, config, db_lnk):
+    ''' Sync manifest for the Origin/Destination pair'''
+    return ntp_sync.SyncManifest(
+        db_lnk.db,
+        ntp_sync.get_pair_key(args.folder_in, args.folder_out),
+        manifest_col=config.get('sync_manifest_col', 'syncManifest')
+    )
+
+def sync_window(args, config, since, id_range, patch_list):
+    ''' Sync an id window in a worker process, returns its report'''
+    logging.basicConfig(stream=sys.stdout, format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y-%m-%d|%H:%M:%S')
+    logging.getLogger().setLevel(10 if args.debug else 20)
+    db_lnk = Mongo_db(
+        config['MONGODB_HOST'],
+        config['MONGODB_DB'],
+        False,
+        config['MONGODB_AUTH'],
+        credentials=config['MONGODB_CREDENTIALS'],
+        connect_db=True
+    )
+    from_storage, to_storage = get_storages(args, config, db_lnk)
+    manifest = None
+    if args.incremental or args.full:
+        manifest = get_manifest(args, config, db_lnk)
+    logging.info(f"Syncing id window {id_range}")
+    return sync_range(args, from_storage, to_storage, manifest, since, id_range, patch_list)
+
+def sync_range(args, from_storage, to_storage, manifest, since, id_range, patch_list):
+    ''' List, compare and transfer files in id_range, returns a sync report'''
+    report = ntp_sync.new_report()
+
+    # Origin files (all, or changed since the high-water mark) with size, hash and modification time
+    from_info = {
+        file_info['name']: file_info
+        for file_info in from_storage.file_list_since(since, id_range=id_range)
+    }
+    modified = [info['modified'] for info in from_info.values() if info['modified'] is not None]
+    if modified:
+        report['last_modified'] = max(modified)
+
+    if since is not None:
+        # Incremental: destination is not listed, manifest tells what is already synced
+        logging.info(f"Origin: {len(from_info)} Files changed at {args.folder_in} since {since}")
+        synced = manifest.get_entries(from_info)
+        new_files = [file for file in from_info if file not in synced]
+        upd_files = [
+            file for file in from_info
+            if file in synced and (args.replace or not manifest.is_synced(from_info[file], synced[file]))
+        ]
+        logging.info(f"{len(new_files)} new files at Origin")
+        logging.info(f"{len(upd_files)} modified files at Origin")
+        if args.delete:
+            deleted = from_storage.file_deleted_since(since, id_range=id_range)
+            if deleted is None:
+                logging.warning(f"{from_storage.type} storage does not track deletions, use --full to propagate them")
+                deleted = []
+            to_delete = list(manifest.get_entries(set(deleted).difference(from_info)))
+            logging.info(f"{len(to_delete)} files to delete at Destination")
+    else:
+        logging.info(f"Origin: {len(from_info)} Files available at {args.folder_in} ")
+
+        to_info = {
+            file_info['name']: file_info
+            for file_info in to_storage.file_list_info(id_range=id_range)
+        }
+        logging.info(f"Destination: {len(to_info)} Files available at {args.folder_out} ")
+
+        plan = ntp_sync.plan_sync(from_info, to_info, delete=args.delete)
+        new_files = plan['ADD']
+        exist_files = plan['SAME']
+        report['fix'] = len(plan['FIX'])
+        report['same'] = len(exist_files)
+        logging.info(f"{len(new_files)} new files at Origin")
+        logging.info(f"{len(plan['FIX'])} files differing in size or hash at Destination")
+        # Differing copies are always transferred, --replace also transfers identical ones
+        upd_files = plan['FIX']
+        if args.replace:
+            upd_files = plan['FIX'] + exist_files
+            logging.info(f"{len(exist_files)} existing files at Destination")
+
+        if args.delete:
+            to_delete = plan['DEL']
+            logging.info(f"{len(to_delete)} files to delete at Destination")
 
+    report['new'] = len(new_files)
     if args.delete:
-        to_delete = []
-        for file in to_files:
-            if file not in from_files:
-                to_delete.append(file)
-        logging.info(f"{len(to_delete)} files to delete at Destination")
-
-    if args.patch_list:
-        with open(args.patch_list, "w") as patch_file:
+        report['to_delete'] = len(to_delete)
+
+    if patch_list:
+        with open(patch_list, "w") as patch_file:
             if args.delete:
                 for file in to_delete:
                     print(f"DEL {file}", file=patch_file)
-            if args.replace:
-                for file in exist_files:
+            if since is None:
+                for file in plan['FIX']:
+                    print(f"FIX {file}", file=patch_file)
+                if args.replace:
+                    for file in exist_files:
+                        print(f"UPD {file}", file=patch_file)
+            else:
+                for file in upd_files:
                     print(f"UPD {file}", file=patch_file)
             for file in new_files:
                print(f"ADD {file}", file=patch_file)
 
+    if args.check_only:
+        return report
 
-    if not args.check_only:
-        if args.verbose:
-            logging.info(f"Starting transfer")
-
-        n_delete = 0
-        n_transfer = 0
-        n_error = 0
+    if args.verbose:
+        logging.info(f"Starting transfer")
 
-        if args.delete:
+    if args.delete and to_delete:
+        if args.verbose:
+            logging.info(f"Deleting {len(to_delete)} files")
+        try:
+            report['deleted'] = to_storage.delete_many(to_delete)
+        except Exception as e:
+            logging.debug(e)
+            logging.error(f"Error deleting files at Destination")
+        if manifest is not None:
             for file in to_delete:
-                try:
-                    if args.verbose:
-                        logging.info(f"Deleting {file}")
-                    to_storage.delete_file(file)
-                    n_delete += 1
-                except Exception as e:
-                    logging.debug(e)
-                    logging.error(f"Error deleting {file}")
+                manifest.remove(file)
+
+    to_transfer = new_files + upd_files
+    engine = ntp_sync.TransferEngine(
+        from_storage,
+        to_storage,
+        readers=args.readers,
+        writers=args.writers,
+        max_bytes=args.max_inflight * 1024 * 1024
+    )
+    stored, failed = engine.run(to_transfer, sizes={file: from_info[file]['size'] for file in to_transfer})
+    report['transferred'] = len(stored)
+    report['errors'] = len(failed)
+    failed_modified = [from_info[file]['modified'] for file in failed if from_info[file]['modified'] is not None]
+    if failed_modified:
+        report['first_failed'] = min(failed_modified)
+    if manifest is not None:
+        for file in stored:
+            manifest.record(from_info[file])
+    to_storage.close()
+
+    if manifest is not None:
+        if since is None:
+            # Full sync: files already at destination are synced, files gone from origin are not
+            known = manifest.get_all(id_range)
+            if not args.replace:
+                for file in exist_files:
+                    if not manifest.is_synced(from_info[file], known.get(file)):
+                        manifest.record(from_info[file])
+            for file in known:
+                if file not in from_info:
+                    manifest.remove(file)
+        manifest.flush()
+    return report
+
+def update_mark(manifest, report, full=False):
+    ''' Move the manifest high-water mark to the latest origin change seen,
+        or to the oldest failed file so it is listed again'''
+    mark = report['last_modified'] or manifest.high_water_mark()
+    if report['first_failed'] is not None:
+        mark = report['first_failed']
+    if mark is not None:
+        manifest.set_high_water_mark(mark, full=full)
+        logging.info(f"Sync manifest high-water mark set to {mark}")
+
+def get_storages(args, config, db_lnk):
+    ''' Origin and Destination storages from args URIs'''
+    factory = ntpst.StorageFactory(config, db_lnk=db_lnk)
+    uri_from = ntpst.parse_storage_uri(args.folder_in)
+    uri_to = ntpst.parse_storage_uri(args.folder_out)
+    if uri_from[:3] == uri_to[:3]:
+        logging.error("Origin and Destination storages are the same, exiting")
+        sys.exit(1)
+    try:
+        from_storage = factory.get_storage(args.folder_in)
+        to_storage = factory.get_storage(args.folder_out)
+    except (ValueError, KeyError) as err:
+        logging.error(f"Storage not available: {err}")
+        sys.exit(1)
 
-        if args.replace:
-            to_transfer = from_files
-        else:
-            to_transfer = new_files
-        if not args.check_only:
-            for file in to_transfer:
-                try:
-                    if args.verbose:
-                        logging.info(f"Transferring {file} ({n_transfer}/{len(to_transfer)})")
-                    to_storage.file_store(file, from_storage.file_read(file))
-                    n_transfer += 1
-                except Exception as e:
-                    logging.debug(e)
-                    logging.error(f"Error storing {file}")
-                    n_error += 1
-            logging.info(f"Transfer completed. {n_transfer} files transferred, {n_delete} files deleted, {n_error} errors found")
-    else:
-        logging.info(f"no action done (--check_only)")
+    if from_storage.type == 'disk' and not os.path.isdir(from_storage.data_dir):
+        logging.error(f"{from_storage.data_dir} does not exist, exiting")
+        sys.exit(1)
+    if to_storage.type == 'disk' and not os.path.isdir(to_storage.data_dir):
+        try:
+            os.mkdir(to_storage.data_dir)
+            logging.info(f"{to_storage.data_dir} non existent, created")
+        except Exception as err:
+            sys.exit(f"Error creating {to_storage.data_dir} {err}")
+
+    return from_storage, to_storage
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,25 @@
+''' VersionGraph arrays and grouping '''
+from datetime import datetime
+from nextplib import ntp_graph as ntpg
+
+
+def test_empty_graph():
+    graph = ntpg.VersionGraph().freeze()
+    assert list(graph.groups()) == []
+    assert len(graph.last_updates()) == 0
+    assert len(graph.gaps()) == 0
+
+
+def test_groups_and_updates():
+    graph = ntpg.VersionGraph()
+    graph.add('ntp00000005', 'X', updated=['2023-01-01 00:00:00+01', '2023-02-01 00:00:00'])
+    graph.add('ntp00000002', 'Y', updated=datetime(2023, 1, 1))
+    graph.add('ntp00000003', 'X', obsolete=True, updated_to='ntp00000005')
+    graph.add('ntp00000004', None)
+    graph.freeze()
+    assert list(graph.orders) == [2, 3, 4, 5]
+    groups = {graph.place_ids[code]: list(graph.orders[positions]) for code, positions in graph.groups()}
+    assert groups == {'X': [3, 5], 'Y': [2]}
+    assert list(graph.last_updates()) == [
+        ntpg.get_epoch('2023-01-01 00:00:00'), ntpg.NO_CODE, ntpg.NO_CODE, ntpg.get_epoch('2023-02-01 00:00:00')
+    ]
@@ -0,0 +1,40 @@
+''' NtpStorageCached on top of a disk storage '''
+from nextplib import ntp_storage as ntpst
+
+
+def get_storages(tmp_path):
+    disk = ntpst.NtpStorageDisk(data_dir=str(tmp_path / 'data'))
+    (tmp_path / 'data').mkdir()
+    return disk, ntpst.NtpStorageCached(disk, str(tmp_path / 'cache'), max_size=1024 * 1024)
+
+
+def test_reads_are_cached(tmp_path):
+    disk, cached = get_storages(tmp_path)
+    disk.file_store('ntp00000001_doc.pdf', b'first')
+    assert cached.file_read('ntp00000001_doc.pdf') == b'first'
+    assert cached.file_open('ntp00000001_doc.pdf').read() == b'first'
+    assert (cached.hits, cached.misses) == (1, 1)
+
+
+def test_mutations_invalidate_cache(tmp_path):
+    disk, cached = get_storages(tmp_path)
+    for file_name in ('ntp00000001_doc.pdf', 'ntp00000002_doc.pdf'):
+        disk.file_store(file_name, b'old')
+        cached.file_read(file_name)
+    cached.file_store_many([('ntp00000001_doc.pdf', b'new')])
+    assert cached.file_read('ntp00000001_doc.pdf') == b'new'
+    assert dict(cached.file_read_many(['ntp00000001_doc.pdf'])) == {'ntp00000001_doc.pdf': b'new'}
+    assert cached.delete_many(['ntp00000002_doc.pdf']) == 1
+    assert cached.file_exists_many(['ntp00000002_doc.pdf']) == {'ntp00000002_doc.pdf': False}
+    assert cached.file_open('ntp00000002_doc.pdf') is None
+
+
+def test_listings_delegated(tmp_path):
+    disk, cached = get_storages(tmp_path)
+    disk.file_store('ntp00000001_doc.pdf', b'contents')
+    assert [info['size'] for info in cached.file_list_since()] == [8]
+    assert [info['name'] for info in cached.file_list_info()] == ['ntp00000001_doc.pdf']
+    assert cached.file_deleted_since(None) is None
+    assert cached.file_id_quantiles(2) == disk.file_id_quantiles(2)
+    assert not cached.can_copy_from(disk)
+    cached.close()
@@ -0,0 +1,43 @@
+''' TransferEngine between disk storages '''
+from nextplib import ntp_storage as ntpst, ntp_sync
+
+
+class FailingStorage(ntpst.NtpStorageDisk):
+    ''' Disk storage whose reads fail the way NtpStorageSwift.file_read does'''
+    def file_read(self, file_name):
+        return 0
+
+    def file_open(self, file_name):
+        return ntpst.NtpStorage.file_open(self, file_name)
+
+
+def get_storages(tmp_path, origin_class=ntpst.NtpStorageDisk):
+    for folder in ('origin', 'destination'):
+        (tmp_path / folder).mkdir()
+    return (
+        origin_class(data_dir=str(tmp_path / 'origin')),
+        ntpst.NtpStorageDisk(data_dir=str(tmp_path / 'destination'))
+    )
+
+
+def test_transfer(tmp_path):
+    origin, destination = get_storages(tmp_path)
+    file_names = [f"ntp0000000{num}_doc.pdf" for num in range(1, 6)]
+    for file_name in file_names:
+        origin.file_store(file_name, file_name.encode() * 100)
+    engine = ntp_sync.TransferEngine(origin, destination, max_bytes=1000, backoff=0)
+    stored, failed = engine.run(file_names, sizes={file_name: 1900 for file_name in file_names})
+    assert sorted(stored) == file_names
+    assert failed == []
+    assert engine.budget.in_flight == 0
+    for file_name in file_names:
+        assert destination.file_read(file_name) == file_name.encode() * 100
+
+
+def test_failed_read_is_not_stored(tmp_path):
+    origin, destination = get_storages(tmp_path, FailingStorage)
+    origin.file_store('ntp00000001_doc.pdf', b'contents')
+    engine = ntp_sync.TransferEngine(origin, destination, retries=1, backoff=0)
+    assert engine.run(['ntp00000001_doc.pdf']) == ([], ['ntp00000001_doc.pdf'])
+    assert not destination.file_exists('ntp00000001_doc.pdf')
+    assert engine.budget.in_flight == 0
@@ -0,0 +1,50 @@
+''' Selection of documents to purge '''
+import argparse
+import purge_documents
+
+
+class FakeCollection:
+    ''' find() over a list of documents, enough for get_obsolete_ids'''
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, query, projection=None, sort=None):
+        self.queries.append(query)
+        if '_id' in query:
+            return [doc for doc in self.docs if doc['_id'] == query['_id']]
+        return sorted(self.docs, key=lambda doc: doc['_id'])
+
+
+def get_args(ntp_id=None, ini=None, fin=None):
+    return argparse.Namespace(id=ntp_id, ini=ini, fin=fin)
+
+
+def test_id_query():
+    assert purge_documents.get_query(get_args(ntp_id='ntp00000002')) == {'_id': 'ntp00000002'}
+
+
+def test_range_query():
+    assert purge_documents.get_query(get_args(ini='ntp00000001')) == {'$and': [
+        {'obsolete_version': {'$exists': 1}},
+        {'_id': {'$gte': 'ntp00000001'}}
+    ]}
+
+
+def test_id_obsolete():
+    col = FakeCollection([
+        {'_id': 'ntp00000001', 'obsolete_version': True},
+        {'_id': 'ntp00000002', 'obsolete_version': True},
+    ])
+    recover_ids = []
+    query = purge_documents.get_query(get_args(ntp_id='ntp00000002'))
+    assert list(purge_documents.get_obsolete_ids(col, query, recover_ids)) == ['ntp00000002']
+    assert recover_ids == []
+
+
+def test_id_active_is_recovered():
+    col = FakeCollection([{'_id': 'ntp00000001', 'id': 'place'}])
+    recover_ids = []
+    query = purge_documents.get_query(get_args(ntp_id='ntp00000001'))
+    assert list(purge_documents.get_obsolete_ids(col, query, recover_ids)) == []
+    assert recover_ids == ['ntp00000001']